@@ -5,3 +5,5 @@ Events can be listed by month, keyword, location or author.
 from __future__ import unicode_literals
 
 __version__ = "0.2.0"
+
+default_app_config = "mezzanine_agenda.apps.AgendaConfig"
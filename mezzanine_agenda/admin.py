@@ -4,6 +4,7 @@ from copy import deepcopy
 from mezzanine.conf import settings
 
 from django.contrib import admin
+from django.utils.translation import ugettext_lazy as _
 from mezzanine.core.admin import TeamOwnableAdmin
 from mezzanine_agenda.models import Event, EventLocation, EventPrice, EventCategory,\
     ExternalShop, Season
@@ -30,6 +31,7 @@ class EventAdmin(TeamOwnableAdmin, DisplayableAdmin):
     list_filter = deepcopy(DisplayableAdmin.list_filter) + ("location",)
     ordering = ('-start',)
     form = EventAdminForm
+    actions = ["propagate_to_children"]
 
     def save_form(self, request, form, change):
         """
@@ -38,6 +40,20 @@ class EventAdmin(TeamOwnableAdmin, DisplayableAdmin):
         OwnableAdmin.save_form(self, request, form, change)
         return DisplayableAdmin.save_form(self, request, form, change)
 
+    def propagate_to_children(self, request, queryset):
+        """
+        Push the values children take from their parent to the children
+        of the selected events.
+        """
+        count = sum(event.propagate_to_children() for event in queryset)
+        self.message_user(
+            request,
+            _("%(count)d child event(s) updated.") % {"count": count}
+        )
+    propagate_to_children.short_description = _(
+        "Update the child events of the selected events"
+    )
+
 
 class EventLocationAdmin(admin.ModelAdmin):
     """
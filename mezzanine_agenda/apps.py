@@ -0,0 +1,12 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+
+
+class AgendaConfig(AppConfig):
+
+    name = "mezzanine_agenda"
+
+    def ready(self):
+        # connect the cache invalidation receivers
+        from mezzanine_agenda import cache  # noqa: F401
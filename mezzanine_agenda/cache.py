@@ -0,0 +1,308 @@
+"""
+Caching of the agenda's frequently used data, along with the signal
+receivers invalidating it. Receivers are connected when the app is
+ready, see ``mezzanine_agenda.apps``.
+
+Most values are cached under keys including a version number shared
+through the cache backend, which is incremented whenever agenda data
+changes. Invalidating everything is thus a single operation, and stays
+consistent across servers sharing the same cache.
+"""
+from __future__ import unicode_literals
+
+from functools import wraps
+from hashlib import md5
+from math import ceil
+from time import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models import Min, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.translation import get_language
+
+from mezzanine.conf import settings
+from mezzanine.generic.models import AssignedKeyword, Keyword
+from mezzanine.utils.sites import current_site_id
+
+from mezzanine_agenda.models import Event, EventCategory, EventLocation,\
+    EventPrice, Season
+from mezzanine_agenda.recurrence import next_boundary
+from mezzanine_agenda.utils import clear_site_domains
+
+VERSION_KEY = "mezzanine_agenda.version"
+
+# reverse relations of events whose rows are shown in agenda pages
+EVENT_RELATED_MODELS = ("links", "images", "periods", "departments")
+
+_start_date_indexes = {}
+
+
+def _new_version():
+    # time based, so that a version evicted from the cache doesn't
+    # start over and match keys cached before
+    return int(time() * 1000)
+
+
+def get_version():
+    """
+    Return the current version of the agenda cache.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _new_version(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    """
+    Invalidate every value cached under a versioned key.
+    """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, _new_version(), None)
+
+
+def cache_key(name, *args):
+    """
+    Build a versioned key of the agenda cache for ``name`` and
+    ``args``, specific to the current site and language.
+    """
+    args = md5(repr(args).encode("utf-8")).hexdigest()
+    return "mezzanine_agenda.%s.%s.%s.%s.%s" % (
+        name, get_version(), current_site_id(), get_language(), args
+    )
+
+
+def next_transition():
+    """
+    Return the next date at which an event starts, ends, gets published
+    or expires, i.e. the next time lists of published, upcoming or past
+    events can change without any edit. Return ``None`` if there's no
+    such date.
+
+    The starts and ends of the occurrences of recurring events count as
+    well. The date is computed with one ``MIN`` query per date column,
+    each using its index, plus the boundaries of the recurring events
+    from ``_recurring_boundaries``, and cached until it passes or
+    agenda data changes.
+    """
+    now = timezone.now()
+    key = cache_key("next_transition")
+    transition = cache.get(key)
+    if transition is None or (transition and transition <= now):
+        dates = []
+        for field in ("start", "end", "publish_date", "expiry_date"):
+            date = Event.objects.filter(**{"%s__gt" % field: now}).aggregate(
+                date=Min(field)
+            )["date"]
+            if date is not None:
+                dates.append(date)
+        dates.extend(_recurring_boundaries(now).values())
+        # an empty string caches the absence of transition
+        transition = min(dates) if dates else ""
+        cache.set(key, transition, _timeout_until(transition, now))
+    return transition or None
+
+
+def _recurring_boundaries(now):
+    """
+    Return the next date at which an occurrence starts or ends, by id
+    of the recurring events which haven't ended. Cached until agenda
+    data changes, only the dates which have passed are computed again.
+    """
+    key = cache_key("recurring_boundaries")
+    boundaries = cache.get(key)
+    if boundaries is None:
+        boundaries = {}
+        events = Event.objects.exclude(recurrence="").filter(
+            Q(recurrence_end__isnull=True) | Q(recurrence_end__gt=now)
+        )
+    else:
+        passed = [pk for pk, boundary in boundaries.items() if boundary <= now]
+        if not passed:
+            return boundaries
+        boundaries = {
+            pk: boundary for pk, boundary in boundaries.items() if boundary > now
+        }
+        events = Event.objects.filter(id__in=passed)
+    for event in events.only("start", "end", "recurrence"):
+        boundary = next_boundary(event, now)
+        if boundary is not None:
+            boundaries[event.pk] = boundary
+    cache.set(key, boundaries, settings.EVENT_CACHE_TIMEOUT)
+    return boundaries
+
+
+def _timeout_until(transition, now):
+    timeout = settings.EVENT_CACHE_TIMEOUT
+    if transition:
+        seconds = int(ceil((transition - now).total_seconds()))
+        timeout = max(1, min(timeout, seconds))
+    return timeout
+
+
+def transition_timeout():
+    """
+    Return the number of seconds until the next transition returned by
+    ``next_transition``, at most ``EVENT_CACHE_TIMEOUT``. Time
+    dependent values cached for this long are never stale.
+    """
+    return _timeout_until(next_transition(), timezone.now())
+
+
+def get_or_set(key, compute, timeout=None):
+    """
+    Return the value cached under ``key``, calling ``compute`` to
+    produce and cache it when missing. ``timeout`` defaults to the
+    time left until the next event transition, as most agenda values
+    depend on which events are published, upcoming or past.
+    """
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        if timeout is None:
+            timeout = transition_timeout()
+        cache.set(key, value, timeout)
+    return value
+
+
+def cache_result(name, timeout=None):
+    """
+    Decorator caching the result of a function under a versioned key
+    built from its arguments.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = cache_key(name, args, sorted(kwargs.items()))
+            return get_or_set(key, lambda: func(*args, **kwargs), timeout)
+        return wrapper
+    return decorator
+
+
+def cache_tag(name):
+    """
+    Decorator caching the result of a template tag like ``cache_result``
+    when ``EVENT_TAG_CACHE`` is enabled.
+    """
+    def decorator(func):
+        cached = cache_result(name)(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if settings.EVENT_TAG_CACHE:
+                return cached(*args, **kwargs)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_date_index(staff=False):
+    """
+    Return the ``(start, id)`` pairs of the published top-level events
+    of the current site ordered by start date, or of all of them for
+    ``staff``. Used to find the neighbours of an event without querying
+    the database.
+
+    The index is kept in the process, and rebuilt with one query when
+    the agenda version changes or the next event transition passes.
+    """
+    key = (current_site_id(), staff)
+    version = get_version()
+    cached = _start_date_indexes.get(key)
+    if cached is None or cached[0] != version or \
+            (cached[1] and cached[1] <= timezone.now()):
+        events = Event.objects.all() if staff else Event.objects.published()
+        index = list(
+            events.filter(parent__isnull=True).order_by("start", "id")
+            .values_list("start", "id")
+        )
+        cached = _start_date_indexes[key] = (version, next_transition(), index)
+    return cached[2]
+
+
+def _excluded_keywords_key(site_id):
+    return "mezzanine_agenda.excluded_keywords.%s" % site_id
+
+
+def get_excluded_keywords():
+    """
+    Return the keywords of ``EVENT_EXCLUDE_TAG_LIST`` mapped to their
+    id. They're cached until a keyword is saved or deleted.
+    """
+    ids = tuple(settings.EVENT_EXCLUDE_TAG_LIST)
+    key = _excluded_keywords_key(current_site_id())
+    cached = cache.get(key)
+    if cached is None or cached[0] != ids:
+        cached = (ids, Keyword.objects.in_bulk(ids) if ids else {})
+        cache.set(key, cached, None)
+    return cached[1]
+
+
+@receiver(post_save, sender=Keyword)
+@receiver(post_delete, sender=Keyword)
+def invalidate_excluded_keywords(sender, instance, **kwargs):
+    cache.delete(_excluded_keywords_key(instance.site_id))
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def invalidate_site_domains(sender, **kwargs):
+    clear_site_domains()
+    bump_version()
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+@receiver(post_save, sender=EventLocation)
+@receiver(post_delete, sender=EventLocation)
+@receiver(post_save, sender=EventCategory)
+@receiver(post_delete, sender=EventCategory)
+@receiver(post_save, sender=EventPrice)
+@receiver(post_delete, sender=EventPrice)
+@receiver(post_save, sender=Season)
+@receiver(post_delete, sender=Season)
+@receiver(post_save, sender=Keyword)
+@receiver(post_delete, sender=Keyword)
+@receiver(m2m_changed, sender=Event.prices.through)
+def invalidate_agenda(sender, **kwargs):
+    bump_version()
+    # requests served before the transaction is committed, e.g. while
+    # the admin saves the inlines of an event, may cache the previous
+    # data under the new version
+    transaction.on_commit(bump_version)
+
+
+def connect_related_receivers():
+    """
+    Invalidate the agenda cache when the related rows of events listed
+    in ``EVENT_RELATED_MODELS``, such as the links annotated by
+    ``with_booking_state``, are saved or deleted.
+    """
+    for name in EVENT_RELATED_MODELS:
+        try:
+            model = Event._meta.get_field(name).related_model
+        except FieldDoesNotExist:
+            continue
+        uid = "mezzanine_agenda.invalidate_%s" % name
+        post_save.connect(invalidate_agenda, sender=model, dispatch_uid=uid)
+        post_delete.connect(invalidate_agenda, sender=model, dispatch_uid=uid)
+
+
+connect_related_receivers()
+
+
+@receiver(post_save, sender=AssignedKeyword)
+@receiver(post_delete, sender=AssignedKeyword)
+def invalidate_agenda_keywords(sender, instance, **kwargs):
+    content_type = ContentType.objects.get_for_id(instance.content_type_id)
+    if content_type.model_class() is Event:
+        invalidate_agenda(sender)
@@ -94,6 +94,27 @@ register_setting(
     default="maps.google.com",
 )
 
+register_setting(
+    name="EVENT_GEOCODER",
+    description=_(
+        "Dotted path to the geocoder class finding the coordinates of "
+        "event locations. Use mezzanine_agenda.geocoding.DummyGeocoder "
+        "to save locations without coordinates when offline."
+    ),
+    editable=False,
+    default="mezzanine_agenda.geocoding.GoogleGeocoder",
+)
+
+register_setting(
+    name="EVENT_GEOCODE_ASYNC",
+    description=_(
+        "Don't geocode event locations when saving them, but queue them "
+        "for the agenda_geocode management command."
+    ),
+    editable=False,
+    default=False,
+)
+
 register_setting(
     name="EVENT_TIME_ZONE",
     description="The timezone that event times are written in, if different from the timezone in settings.TIME_ZONE",  # noqa: E501
@@ -101,6 +122,105 @@ register_setting(
     default="",
 )
 
+register_setting(
+    name="EVENT_CACHE_TIMEOUT",
+    description=_(
+        "Maximum number of seconds event lists, facets, tags and template "
+        "tag results are cached. Cached values are invalidated as soon as "
+        "events, locations, categories, prices, keywords or seasons "
+        "change, and when an event starts, ends, gets published or "
+        "expires."
+    ),
+    editable=False,
+    default=60 * 60,
+)
+
+register_setting(
+    name="EVENT_TAG_CACHE",
+    description=_(
+        "Cache the results of the agenda template tags, such as "
+        "upcoming_events or calendar_month, until agenda data changes. "
+        "event_months, event_locations and event_authors are always cached."
+    ),
+    editable=False,
+    default=True,
+)
+
+register_setting(
+    name="EVENT_ICAL_CHUNK_SIZE",
+    description=_(
+        "Number of events fetched at once from the database when "
+        "streaming iCalendar feeds."
+    ),
+    editable=False,
+    default=500,
+)
+
+register_setting(
+    name="EVENT_ICAL_CACHE_TIMEOUT",
+    description=_(
+        "Number of seconds the serialized iCalendar entry of an event is "
+        "cached. Entries are refreshed whenever the event is saved, the "
+        "timeout only bounds how long changes to its location can go "
+        "unnoticed."
+    ),
+    editable=False,
+    default=60 * 60 * 24,
+)
+
+register_setting(
+    name="EVENT_ICAL_SERIES",
+    description=_(
+        "If ``True``, iCalendar feeds encode the children of an event as "
+        "dates of its entry (RRULE or RDATE), with separate entries only "
+        "for the children differing from it, instead of one entry per "
+        "child."
+    ),
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="EVENT_DAY_COUNTS_MAX_DAYS",
+    description=_(
+        "Maximum number of days of the range requested to the per-day "
+        "event counts JSON view."
+    ),
+    editable=False,
+    default=366,
+)
+
+register_setting(
+    name="EVENT_PROPAGATION_BATCH_SIZE",
+    description=_(
+        "Number of child events updated per query when the changes of "
+        "their parent are pushed to them."
+    ),
+    editable=False,
+    default=200,
+)
+
+register_setting(
+    name="EVENT_RECURRENCE_HORIZON",
+    description=_(
+        "Number of days ahead for which the occurrences of recurring "
+        "events are listed."
+    ),
+    editable=False,
+    default=365,
+)
+
+register_setting(
+    name="EVENT_RECURRENCE_MAX_OCCURRENCES",
+    description=_(
+        "Maximum number of occurrences of a recurring event, in total or "
+        "within ``EVENT_RECURRENCE_HORIZON`` days for endless rules. "
+        "Longer rules are rejected when editing events."
+    ),
+    editable=False,
+    default=1000,
+)
+
 register_setting(
     name="EVENT_HIDPI_STATIC_MAPS",
     description="Generate maps suitable for Retina displays",
@@ -108,6 +228,26 @@ register_setting(
     default=True,
 )
 
+register_setting(
+    name="EVENT_STATIC_MAPS_STORAGE",
+    description=_(
+        "Download the Google static maps of event locations once into "
+        "the media storage and serve them from there."
+    ),
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="EVENT_STATIC_MAPS_FETCHER",
+    description=_(
+        "Dotted path to the function downloading a static map image, "
+        "given its URL."
+    ),
+    editable=False,
+    default="mezzanine_agenda.maps.fetch_static_map",
+)
+
 register_setting(
     name="PAST_EVENTS",
     label=_("Past events"),
@@ -7,7 +7,7 @@ from django.utils.feedgenerator import Atom1Feed
 from django.utils.html import strip_tags
 
 from mezzanine.core.templatetags.mezzanine_tags import richtext_filters
-from mezzanine_agenda.models import Event, EventLocation
+from mezzanine_agenda.models import Event, EventLocation, prime_absolute_urls
 from mezzanine.generic.models import Keyword
 from mezzanine.pages.models import Page
 from mezzanine.conf import settings
@@ -58,9 +58,13 @@ class EventsRSS(Feed):
     def link(self):
         return reverse("event_list")
 
-    def items(self):
+    def get_events(self):
+        """
+        Return all the events of the feed, before applying
+        ``EVENT_RSS_LIMIT``.
+        """
         if not self._public:
-            return []
+            return Event.objects.none()
         events = Event.objects.published().select_related("user")
         if self.tag:
             tag = get_object_or_404(Keyword, slug=self.tag)
@@ -71,10 +75,14 @@ class EventsRSS(Feed):
         if self.username:
             author = get_object_or_404(User, username=self.username)
             events = events.filter(user=author)
+        return events
+
+    def items(self):
+        events = self.get_events()
         limit = settings.EVENT_RSS_LIMIT
         if limit is not None:
             events = events[:settings.EVENT_RSS_LIMIT]
-        return events
+        return prime_absolute_urls(list(events))
 
     def item_description(self, item):
         return richtext_filters(item.content)
@@ -1,16 +1,86 @@
 from django import forms
-from mezzanine_agenda.models import EventCategory, EventLocation, EventPrice
+from django.db.models import Count
+from mezzanine_agenda.models import Event, EventCategory, EventLocation, EventPrice
 from dal import autocomplete
 
 
+def get_event_facets(events, category_ids=None, location_ids=None):
+    """
+    Return the categories and locations of ``events`` along with their
+    number of events, as lists of ``(object, event_count)`` pairs.
+    Counts come from a single query grouped by category and location.
+
+    Categories are counted among the events of the selected
+    ``location_ids``, and locations among the events of the selected
+    ``category_ids``, so that each count is the number of results
+    selecting the option would give. Options without such events are
+    left out, unless they're selected.
+    """
+    groups = events.order_by().values("category_id", "location_id").annotate(
+        event_count=Count("id", distinct=True)
+    )
+    category_ids = set(int(pk) for pk in category_ids or [])
+    location_ids = set(int(pk) for pk in location_ids or [])
+    category_counts, location_counts = {}, {}
+    for group in groups:
+        category_id, location_id = group["category_id"], group["location_id"]
+        if category_id is not None:
+            count = group["event_count"]
+            if location_ids and location_id not in location_ids:
+                count = 0
+            category_counts[category_id] = category_counts.get(category_id, 0) + count
+        if location_id is not None:
+            count = group["event_count"]
+            if category_ids and category_id not in category_ids:
+                count = 0
+            location_counts[location_id] = location_counts.get(location_id, 0) + count
+    category_counts = {
+        pk: category_counts.get(pk, 0)
+        for pk in category_ids.union(category_counts)
+        if category_counts.get(pk) or pk in category_ids
+    }
+    location_counts = {
+        pk: location_counts.get(pk, 0)
+        for pk in location_ids.union(location_counts)
+        if location_counts.get(pk) or pk in location_ids
+    }
+    categories = EventCategory.objects.in_bulk(list(category_counts))
+    locations = EventLocation.objects.in_bulk(list(location_counts))
+    return {
+        "categories": sorted(
+            [(categories[pk], count) for pk, count in category_counts.items()
+             if pk in categories],
+            key=lambda facet: str(facet[0])
+        ),
+        "locations": sorted(
+            [(locations[pk], count) for pk, count in location_counts.items()
+             if pk in locations],
+            key=lambda facet: str(facet[0])
+        ),
+    }
+
+
 class EventFilterForm(forms.Form):
+    """
+    Filter events by category and location. Choices are the ids of
+    the categories and locations having events, labelled with their
+    number of events. ``facets`` defaults to the facets of all
+    published events.
+    """
 
     def __init__(self, *args, **kwargs):
+        facets = kwargs.pop("facets", None)
         super(EventFilterForm, self).__init__(*args, **kwargs)
-        event_categories = EventCategory.objects.all()
-        event_categories = [(cat.name, cat.name) for cat in event_categories]
-        event_locations = EventLocation.objects.distinct('title')
-        event_locations = [(loc.title, loc.title) for loc in event_locations]
+        if facets is None:
+            facets = get_event_facets(Event.objects.published())
+        event_categories = [
+            (str(cat.pk), "%s (%s)" % (cat, count))
+            for cat, count in facets["categories"]
+        ]
+        event_locations = [
+            (str(loc.pk), "%s (%s)" % (loc, count))
+            for loc, count in facets["locations"]
+        ]
         self.fields['event_categories_filter'] = forms.MultipleChoiceField(
             required=False,
             widget=forms.CheckboxSelectMultiple,
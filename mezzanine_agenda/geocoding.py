@@ -0,0 +1,67 @@
+"""
+Geocoder backends turning the mappable location of an event location
+into coordinates. The backend used is the class named by the
+``EVENT_GEOCODER`` setting, whose ``geocode`` method takes an address
+and returns a ``(mappable_location, lat, lon)`` tuple, or ``None`` if
+the address can't be found.
+"""
+from __future__ import unicode_literals
+
+import re
+
+from geopy.exc import GeopyError
+from geopy.geocoders import GoogleV3 as GoogleMaps
+
+from mezzanine.conf import settings
+from mezzanine.utils.importing import import_dotted_path
+
+
+class GeocodingError(Exception):
+    """
+    Raised by geocoders when the geocoding service fails.
+    """
+
+
+class GoogleGeocoder(object):
+    """
+    Geocode with the Google Maps API.
+    """
+
+    def __init__(self):
+        self.geocoder = GoogleMaps(
+            api_key=settings.GOOGLE_API_KEY,
+            domain=settings.EVENT_GOOGLE_MAPS_DOMAIN
+        )
+
+    def geocode(self, query):
+        try:
+            location = self.geocoder.geocode(query)
+        except GeopyError as e:
+            raise GeocodingError(str(e))
+        if location is None:
+            return None
+        return location.address, location.latitude, location.longitude
+
+
+class DummyGeocoder(object):
+    """
+    Offline stand-in accepting every address, without coordinates.
+    """
+
+    def geocode(self, query):
+        return query, None, None
+
+
+def get_geocoder():
+    """
+    Return an instance of the ``EVENT_GEOCODER`` backend.
+    """
+    return import_dotted_path(settings.EVENT_GEOCODER)()
+
+
+def normalize_query(query):
+    """
+    Normalize an address so that spelling variants of the same address
+    share the same cached coordinates.
+    """
+    return re.sub(r"\s*,\s*", ", ", " ".join(query.split())).strip(", ").lower()
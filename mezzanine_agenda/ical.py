@@ -0,0 +1,200 @@
+"""
+iCalendar generation for the agenda's calendar feeds.
+"""
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from datetime import timedelta
+from itertools import islice
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils.translation import get_language
+from icalendar import Calendar
+
+from mezzanine.conf import settings
+
+from mezzanine_agenda import __version__
+from mezzanine_agenda.cache import get_version
+from mezzanine_agenda.models import prime_absolute_urls
+from mezzanine_agenda.recurrence import make_vtimezone
+from mezzanine_agenda.utils import event_timezone, site_domain
+
+CALENDAR_END = b"END:VCALENDAR\r\n"
+
+
+def make_calendar():
+    """
+    Create an icalendar object, with the VTIMEZONE of the events'
+    time zone.
+    """
+    calendar = Calendar()
+    calendar.add(
+        'prodid',
+        '-//mezzanine-agenda//NONSGML V{}//EN'.format(__version__)
+    )
+    calendar.add('version', '2.0')  # version of the format, not the product!
+    # recurring events are written in this time zone
+    calendar.add_component(make_vtimezone(event_timezone()))
+    return calendar
+
+
+def stream_calendar(events, domain=None, series=None):
+    """
+    Return an iterator over the serialized iCalendar file of
+    ``events``, for use with a ``StreamingHttpResponse``.
+
+    The site domain is resolved once, and events are read in chunks of
+    ``EVENT_ICAL_CHUNK_SIZE`` rows and written out one VEVENT at a
+    time, so memory use doesn't depend on the number of events. The
+    VEVENT of each event is cached until agenda data changes.
+
+    With ``series``, defaulting to ``EVENT_ICAL_SERIES``, the children
+    of an event are encoded in the VEVENT of their parent, see
+    ``series_components``.
+    """
+    if domain is None:
+        domain = site_domain()
+    if series is None:
+        series = settings.EVENT_ICAL_SERIES
+    return _calendar_chunks(events.select_related("location"), domain, series)
+
+
+def fragment_key(event_id, updated, domain, children=None, version=None):
+    """
+    Cache key of the serialized VEVENT of an event, which changes
+    whenever the event is saved, or agenda data such as its location
+    changes. ``children`` is the ``(count, last_updated)`` state of the
+    children encoded along with it. ``version`` defaults to the current
+    version of the agenda cache.
+    """
+    if version is None:
+        version = get_version()
+    key = "mezzanine_agenda.vevent.{version}.{domain}.{language}.{id}.{updated}".format(
+        version=version,
+        domain=domain,
+        language=get_language(),
+        id=event_id,
+        updated=updated.timestamp() if updated else "",
+    )
+    if children is not None:
+        key += ".{count}.{updated}".format(
+            count=children[0],
+            updated=children[1].timestamp() if children[1] else "",
+        )
+    return key
+
+
+def regular_rule(start, starts):
+    """
+    Return the RRULE repeating an event starting at ``start`` at each
+    of the following ``starts``, if they're a whole number of days or
+    weeks apart, otherwise ``None``.
+    """
+    deltas = set(b - a for a, b in zip([start] + starts, starts))
+    if len(deltas) != 1:
+        return None
+    delta = deltas.pop()
+    if delta <= timedelta(0) or delta % timedelta(days=1):
+        return None
+    if delta.days % 7:
+        rule = {"freq": "daily", "interval": delta.days}
+    else:
+        rule = {"freq": "weekly", "interval": delta.days // 7}
+    rule["count"] = len(starts) + 1
+    return rule
+
+
+def _signature(event):
+    duration = event.end - event.start if event.end else None
+    return event.title, event.location_id, duration
+
+
+def series_components(event, children, domain):
+    """
+    Return the VEVENTs encoding ``event`` and its ``children``: a
+    master VEVENT repeated at the children's dates with an RRULE when
+    they're regular or RDATEs otherwise, followed by RECURRENCE-ID
+    overrides for the children whose title, location or duration
+    differ from the event's.
+    """
+    master = event.get_icalendar_event(domain=domain)
+    if not children:
+        return [master]
+    starts = [child.start for child in children]
+    rule = None if event.recurrence else regular_rule(event.start, starts)
+    if rule:
+        master.add("rrule", rule)
+    else:
+        master.add("rdate", starts)
+    components = [master]
+    for child in children:
+        if _signature(child) != _signature(event):
+            override = child.get_icalendar_event(domain=domain)
+            override["uid"] = master["uid"]
+            override.add("recurrence-id", child.start)
+            components.append(override)
+    return components
+
+
+def event_fragments(events, rows, domain, series=False):
+    """
+    Yield the serialized VEVENT of each ``(id, updated)`` row, taken
+    from the cache when possible. Only new or changed events are
+    fetched from ``events`` and serialized. With ``series``, the
+    children of each event in ``events`` are encoded with it.
+    """
+    children_state = {}
+    if series:
+        children_state = {
+            row["parent_id"]: (row["count"], row["last_updated"])
+            for row in events.filter(
+                parent_id__in=[pk for pk, updated in rows]
+            ).order_by().values("parent_id").annotate(
+                count=Count("id"),
+                last_updated=Max("updated")
+            )
+        }
+    version = get_version()
+    keys = {
+        pk: fragment_key(pk, updated, domain, children_state.get(pk), version)
+        for pk, updated in rows
+    }
+    fragments = cache.get_many(keys.values())
+    missing = [pk for pk, key in keys.items() if key not in fragments]
+    if missing:
+        children = defaultdict(list)
+        for child in prime_absolute_urls(list(events.filter(
+            parent_id__in=[pk for pk in missing if pk in children_state]
+        ).order_by("start"))):
+            children[child.parent_id].append(child)
+        serialized = {
+            keys[event.pk]: b"".join(
+                component.to_ical()
+                for component in series_components(event, children[event.pk], domain)
+            )
+            for event in prime_absolute_urls(list(events.filter(pk__in=missing)))
+        }
+        cache.set_many(serialized, settings.EVENT_ICAL_CACHE_TIMEOUT)
+        fragments.update(serialized)
+    for pk, updated in rows:
+        if keys[pk] in fragments:
+            yield fragments[keys[pk]]
+
+
+def _calendar_chunks(events, domain, series=False):
+    header = make_calendar().to_ical()
+    yield header[:-len(CALENDAR_END)]
+    chunk_size = settings.EVENT_ICAL_CHUNK_SIZE
+    rows = events
+    if series:
+        # children are encoded with their parent when it's listed too
+        rows = events.exclude(parent__in=events.order_by().values("id"))
+    rows = rows.values_list("id", "updated").iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        for fragment in event_fragments(events, chunk, domain, series):
+            yield fragment
+    yield CALENDAR_END
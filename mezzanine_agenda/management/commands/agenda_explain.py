@@ -0,0 +1,86 @@
+from __future__ import unicode_literals
+
+from datetime import date, datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+from mezzanine_agenda.models import Event, EventLocation
+
+
+class Command(BaseCommand):
+    """
+    Print the query plan of the agenda's hot queries, to check the
+    event indexes are used by the database.
+    """
+
+    help = "Print EXPLAIN output for each agenda query."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--analyze",
+            action="store_true",
+            help="Run the queries and report actual timings (PostgreSQL only).",
+        )
+        parser.add_argument(
+            "--format",
+            default=None,
+            help="Output format of the plan, e.g. TEXT or JSON (PostgreSQL, MySQL).",
+        )
+
+    def get_queries(self):
+        """
+        Return ``(name, queryset)`` pairs shaped like the ones run by
+        the views and template tags.
+        """
+        now = timezone.now()
+        today = date.today()
+        season_start = datetime.combine(date(today.year - 1, 7, 31), time(0, 0, 0))
+        published = Event.objects.published()
+        location = EventLocation.objects.first()
+        return (
+            ("published", published),
+            ("default ordering", published.order_by("rank", "start")),
+            ("upcoming", published.filter(
+                Q(start__gt=now) | Q(end__gt=now)
+            ).order_by("start")),
+            ("archive season", published.filter(
+                Q(start__range=[season_start, now]) &
+                Q(end__range=[season_start, now])
+            ).order_by("-start")),
+            ("next by start date", published.filter(
+                start__gt=now,
+                parent__isnull=True
+            ).order_by("start")[:1]),
+            ("previous by start date", published.filter(
+                start__lt=now,
+                parent__isnull=True
+            ).order_by("-start")[:1]),
+            ("location", published.filter(
+                location_id=location.id if location else 0
+            ).order_by("start")),
+        )
+
+    def handle(self, *args, **options):
+        explain_options = {}
+        connection = connections[Event.objects.db]
+        if options["analyze"]:
+            if connection.vendor != "postgresql":
+                raise CommandError("--analyze is only supported on PostgreSQL.")
+            explain_options["analyze"] = True
+        if options["format"] and options["format"].upper() not in \
+                connection.features.supported_explain_formats:
+            raise CommandError(
+                "--format %s isn't supported on %s." % (
+                    options["format"], connection.vendor
+                )
+            )
+        for name, queryset in self.get_queries():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(str(queryset.query))
+            self.stdout.write(
+                queryset.explain(format=options["format"], **explain_options)
+            )
+            self.stdout.write("")
@@ -0,0 +1,175 @@
+from __future__ import unicode_literals
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from time import monotonic, sleep
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mezzanine_agenda.cache import bump_version
+from mezzanine_agenda.geocoding import GeocodingError, get_geocoder, normalize_query
+from mezzanine_agenda.models import EventLocation, GeocodeCache, GeocodeJob
+
+
+class RateLimiter(object):
+    """
+    Space calls shared by several threads by at least ``1 / rate``
+    seconds.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = Lock()
+        self.next_call = monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+class Command(BaseCommand):
+    """
+    Geocode the event locations queued by ``EVENT_GEOCODE_ASYNC`` or
+    ``agenda_geocode_backfill``.
+    """
+
+    help = "Geocode the queued event locations."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of concurrent requests to the geocoder.",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=10,
+            help="Maximum number of requests per second, 0 for no limit.",
+        )
+        parser.add_argument(
+            "--retries",
+            type=int,
+            default=2,
+            help="Number of retries of a failed request.",
+        )
+        parser.add_argument(
+            "--backoff",
+            type=float,
+            default=1,
+            help="Seconds to wait before the first retry, doubled each time.",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=5,
+            help="Number of runs after which a failing job is abandoned.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of jobs processed at once.",
+        )
+
+    def geocode(self, geocoder, limiter, query):
+        """
+        Geocode ``query``, retrying when the service fails. Return the
+        result and the last error.
+        """
+        delay = self.options["backoff"]
+        for attempt in range(self.options["retries"] + 1):
+            if attempt:
+                sleep(delay)
+                delay *= 2
+            limiter.wait()
+            try:
+                return geocoder.geocode(query), None
+            except GeocodingError as e:
+                error = str(e) or e.__class__.__name__
+        return None, error
+
+    def process(self, jobs, geocoder, limiter):
+        """
+        Geocode the locations of ``jobs`` and save the results with a
+        few bulk queries. Return the number of geocoded locations.
+        """
+        queries = {}
+        for job in jobs:
+            location = job.location
+            if location.lat and location.lon:
+                job.status = GeocodeJob.DONE
+                continue
+            if not location.mappable_location:
+                location.mappable_location = location.get_default_mappable_location()
+            queries[job] = normalize_query(location.mappable_location)
+        keys = {query: GeocodeCache.get_key(query) for query in queries.values()}
+        cached = GeocodeCache.with_coordinates().in_bulk(
+            list(keys.values()), field_name="key"
+        )
+        results, errors = {}, {}
+        for query, key in keys.items():
+            if key in cached:
+                results[query] = (
+                    cached[key].mappable_location, cached[key].lat, cached[key].lon
+                )
+        missing = sorted(set(keys) - set(results))
+        workers = max(1, self.options["workers"])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            found = executor.map(partial(self.geocode, geocoder, limiter), missing)
+            for query, (result, error) in zip(missing, found):
+                if error is not None:
+                    errors[query] = error
+                elif result is not None:
+                    results[query] = GeocodeCache.store(query, result)
+        locations = []
+        now = timezone.now()
+        for job in jobs:
+            job.updated = now
+        for job, query in queries.items():
+            job.attempts += 1
+            if query in results:
+                location = job.location
+                location.mappable_location, location.lat, location.lon = \
+                    results[query]
+                locations.append(location)
+                job.status, job.error = GeocodeJob.DONE, ""
+            elif query in errors:
+                job.error = errors[query]
+                if job.attempts >= self.options["max_attempts"]:
+                    job.status = GeocodeJob.FAILED
+            else:
+                job.status, job.error = GeocodeJob.FAILED, "Not found"
+        EventLocation.objects.bulk_update(
+            locations, ["mappable_location", "lat", "lon"]
+        )
+        GeocodeJob.objects.bulk_update(
+            jobs, ["status", "attempts", "error", "updated"]
+        )
+        return len(locations)
+
+    def handle(self, *args, **options):
+        self.options = options
+        geocoder = get_geocoder()
+        limiter = RateLimiter(options["rate"])
+        pending = GeocodeJob.objects.filter(
+            status=GeocodeJob.PENDING
+        ).select_related("location").order_by("id")
+        last_id, total = 0, 0
+        while True:
+            jobs = list(pending.filter(id__gt=last_id)[:options["batch_size"]])
+            if not jobs:
+                break
+            last_id = jobs[-1].id
+            total += self.process(jobs, geocoder, limiter)
+        if total:
+            # bulk updates don't send the signals invalidating the cache
+            bump_version()
+        self.stdout.write("%d location(s) geocoded." % total)
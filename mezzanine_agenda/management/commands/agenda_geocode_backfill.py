@@ -0,0 +1,39 @@
+from __future__ import unicode_literals
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from mezzanine_agenda.models import EventLocation, GeocodeJob
+
+
+class Command(BaseCommand):
+    """
+    Queue the geocoding of every event location missing coordinates.
+    """
+
+    help = "Queue the event locations without coordinates for agenda_geocode."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--drain",
+            action="store_true",
+            help="Run agenda_geocode once the locations are queued.",
+        )
+
+    def handle(self, *args, **options):
+        locations = EventLocation.objects.filter(
+            Q(lat__isnull=True) | Q(lon__isnull=True)
+        )
+        GeocodeJob.objects.filter(location__in=locations).exclude(
+            status=GeocodeJob.PENDING
+        ).update(status=GeocodeJob.PENDING, attempts=0, error="")
+        GeocodeJob.objects.bulk_create([
+            GeocodeJob(location_id=location_id)
+            for location_id in locations.filter(
+                geocode_job__isnull=True
+            ).values_list("id", flat=True)
+        ])
+        self.stdout.write("%d location(s) queued." % locations.count())
+        if options["drain"]:
+            call_command("agenda_geocode", stdout=self.stdout)
@@ -0,0 +1,54 @@
+from __future__ import unicode_literals
+
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from mezzanine_agenda.ical import stream_calendar
+from mezzanine_agenda.models import Event
+
+
+class Command(BaseCommand):
+    """
+    Compare the iCalendar feed of the published events with one VEVENT
+    per child event and with ``EVENT_ICAL_SERIES``.
+    """
+
+    help = "Compare the size and generation time of the iCalendar encodings."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of times each feed is generated.",
+        )
+
+    def measure(self, events, series, repeat):
+        """
+        Generate the feed ``repeat`` times. Return its size, its number
+        of VEVENTs, and the durations of the first, uncached, run and
+        of the fastest run.
+        """
+        timings = []
+        for i in range(max(1, repeat)):
+            started = perf_counter()
+            content = b"".join(stream_calendar(events, series=series))
+            timings.append(perf_counter() - started)
+        return len(content), content.count(b"BEGIN:VEVENT"), timings[0], min(timings)
+
+    def handle(self, *args, **options):
+        events = Event.objects.published().order_by("start")
+        self.stdout.write("%-10s %12s %8s %10s %10s" % (
+            "encoding", "bytes", "vevents", "first (s)", "best (s)"
+        ))
+        results = {}
+        for name, series in (("per-child", False), ("series", True)):
+            results[name] = self.measure(events, series, options["repeat"])
+            self.stdout.write("%-10s %12d %8d %10.4f %10.4f" % (
+                (name,) + results[name]
+            ))
+        if results["per-child"][0]:
+            self.stdout.write("Size ratio: %.2f" % (
+                results["series"][0] / results["per-child"][0]
+            ))
@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from mezzanine.conf import settings
+
+from mezzanine_agenda.models import Event
+from mezzanine_agenda.recurrence import event_occurrences, exclude_dates
+from mezzanine_agenda.utils import event_timezone
+
+
+class Command(BaseCommand):
+    """
+    Turn the occurrences of recurring events into child events, for
+    sites that need them stored. Materialized dates are excluded from
+    the recurrence so that they aren't listed twice.
+    """
+
+    help = "Create child events for the occurrences of recurring events."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--until",
+            help="Last date to materialize (YYYY-MM-DD), by default "
+                 "EVENT_RECURRENCE_HORIZON days from now.",
+        )
+        parser.add_argument(
+            "--event",
+            type=int,
+            action="append",
+            dest="events",
+            help="Id of a recurring event to materialize, all by default.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the number of occurrences to create.",
+        )
+
+    def handle(self, *args, **options):
+        if options["until"]:
+            try:
+                until = datetime.strptime(options["until"], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--until must be a YYYY-MM-DD date.")
+            until += timedelta(days=1)
+            if settings.USE_TZ:
+                until = timezone.make_aware(until, event_timezone())
+        else:
+            until = timezone.now() + timedelta(
+                days=settings.EVENT_RECURRENCE_HORIZON
+            )
+        events = Event.objects.exclude(recurrence="")
+        if options["events"]:
+            events = events.filter(id__in=options["events"])
+        total = 0
+        for event in events:
+            occurrences = [
+                occurrence
+                for occurrence in event_occurrences(event, event.start, until)
+                if occurrence.start < until
+            ]
+            if not occurrences:
+                continue
+            total += len(occurrences)
+            if options["dry_run"]:
+                continue
+            # the children and their exclusion from the recurrence are
+            # saved together, so that a failure doesn't duplicate them
+            with transaction.atomic():
+                for occurrence in occurrences:
+                    Event(
+                        parent=event,
+                        site_id=event.site_id,
+                        title=event.title,
+                        user=event.user,
+                        status=event.status,
+                        publish_date=event.publish_date,
+                        start=occurrence.start,
+                        end=occurrence.end,
+                    ).save()
+                event.recurrence = exclude_dates(
+                    event.recurrence,
+                    [occurrence.start for occurrence in occurrences]
+                )
+                event.save()
+        self.stdout.write("%d occurrence(s) %s." % (
+            total, "to materialize" if options["dry_run"] else "materialized"
+        ))
@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+
+from django.db.models import Exists, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from mezzanine.core.managers import DisplayableManager, SearchableManager,\
+    SearchableQuerySet
+
+
+class EventQuerySet(SearchableQuerySet):
+    """
+    QuerySet adding agenda specific helpers to ``SearchableQuerySet``.
+    """
+
+    def with_booking_state(self):
+        """
+        Annotate the values ``Event.reserve_button`` depends on, so
+        rendering buttons for a list of events doesn't run several
+        queries per event:
+
+        - ``is_free``: whether one of the event's prices is zero.
+        - ``has_vel``: whether the event has a ``vel`` link.
+        - ``vel_url``: the URL of that link.
+        """
+        prices = self.model._meta.get_field("prices").related_model
+        links = self.model._meta.get_field("links")
+        free_prices = prices.objects.filter(events=OuterRef("pk"), value=0.0)
+        vel_links = links.related_model.objects.filter(**{
+            links.field.name: OuterRef("pk"),
+            "link_type__slug": "vel",
+        })
+        return self.select_related("shop").annotate(
+            is_free=Exists(free_prices),
+            has_vel=Exists(vel_links),
+            vel_url=Subquery(vel_links.values("url")[:1]),
+        )
+
+    def upcoming(self, now=None):
+        """
+        Filter the events which are upcoming or ongoing at ``now``,
+        including the recurring events with occurrences to come.
+        """
+        now = now or timezone.now()
+        return self.filter(
+            Q(start__gt=now) | Q(end__gt=now) | Q(recurrence_end__gt=now) |
+            (Q(recurrence_end__isnull=True) & ~Q(recurrence=""))
+        )
+
+
+class EventQuerySetManager(SearchableManager):
+    """
+    ``SearchableManager`` returning ``EventQuerySet`` instances.
+    """
+
+    def get_queryset(self):
+        search_fields = self.get_search_fields()
+        return EventQuerySet(self.model, search_fields=search_fields)
+
+
+class EventManager(DisplayableManager, EventQuerySetManager):
+    """
+    ``DisplayableManager`` for events, whose querysets provide the
+    ``EventQuerySet`` helpers.
+    """
+
+    def with_booking_state(self):
+        return self.get_queryset().with_booking_state()
+
+    def upcoming(self, now=None):
+        return self.get_queryset().upcoming(now)
@@ -0,0 +1,92 @@
+"""
+Google Static Maps images of event locations.
+"""
+from __future__ import unicode_literals
+
+from hashlib import md5, sha1
+from urllib.request import urlopen
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils.http import urlquote as quote
+
+from mezzanine.conf import settings
+from mezzanine.utils.importing import import_dotted_path
+
+from mezzanine_agenda.utils import sign_url
+
+STATIC_MAPS_URL = "https://maps.googleapis.com/maps/api/staticmap"
+
+
+def fetch_static_map(url):
+    """
+    Default ``EVENT_STATIC_MAPS_FETCHER``, downloading the image at
+    ``url``.
+    """
+    with urlopen(url, timeout=10) as response:
+        return response.read()
+
+
+def build_static_map_url(location, width, height, zoom, scale):
+    """
+    Build the Static Maps URL of an event location, signed with
+    ``GOOGLE_STATIC_MAPS_API_SECRET`` when set.
+    """
+    marker = quote('{:.6},{:.6}'.format(location.lat, location.lon))
+    url = "{base}?size={width}x{height}&scale={scale}&format=png&markers={marker}&sensor=false&zoom={zoom}".format(  # noqa: E501
+        base=STATIC_MAPS_URL, width=width, height=height, scale=scale,
+        marker=marker, zoom=zoom,
+    )
+    key = getattr(settings, "GOOGLE_API_KEY", None)
+    if key:
+        url += "&key={key}".format(key=key)
+    secret = getattr(settings, "GOOGLE_STATIC_MAPS_API_SECRET", None)
+    if secret:
+        url = sign_url(input_url=url.encode("utf-8"), secret=secret)
+    return url
+
+
+def store_static_map(url):
+    """
+    Download the image at ``url`` with ``EVENT_STATIC_MAPS_FETCHER``
+    into the default storage, once, and return its URL there.
+    """
+    name = "agenda/maps/%s.png" % sha1(url.encode("utf-8")).hexdigest()
+    if not default_storage.exists(name):
+        fetch = import_dotted_path(settings.EVENT_STATIC_MAPS_FETCHER)
+        name = default_storage.save(name, ContentFile(fetch(url)))
+    return default_storage.url(name)
+
+
+def static_map_url(location, width, height, zoom, scale=1):
+    """
+    Return the URL of the static map of an event location, cached for
+    its coordinates, the requested size, zoom and scale, and the API
+    credentials, for ``EVENT_CACHE_TIMEOUT`` seconds. With
+    ``EVENT_STATIC_MAPS_STORAGE``, the image is served from the
+    default storage instead of Google, falling back to Google when it
+    can't be downloaded, and downloaded again once the cached URL
+    expires if it has been deleted meanwhile.
+    """
+    store = settings.EVENT_STATIC_MAPS_STORAGE
+    # the whole tuple is hashed into the key, the secret isn't exposed
+    parts = (
+        location.pk, location.lat, location.lon, width, height, zoom, scale,
+        store, getattr(settings, "GOOGLE_API_KEY", None),
+        getattr(settings, "GOOGLE_STATIC_MAPS_API_SECRET", None),
+    )
+    key = "mezzanine_agenda.static_map.%s" % md5(
+        repr(parts).encode("utf-8")
+    ).hexdigest()
+    url = cache.get(key)
+    if url is None:
+        url = build_static_map_url(location, width, height, zoom, scale)
+        if store:
+            try:
+                url = store_static_map(url)
+            except OSError:
+                # retry on a later render
+                return url
+        cache.set(key, url, settings.EVENT_CACHE_TIMEOUT)
+    return url
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0043_auto_20210823_1742'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['start', 'end'], name='agenda_event_start_end'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['end'], name='agenda_event_end'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['rank', 'start'], name='agenda_event_rank_start'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['parent', 'start'], name='agenda_event_parent_start'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['location', 'start'], name='agenda_event_location_start'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['status', 'publish_date'], name='agenda_event_status_publish'),
+        ),
+    ]
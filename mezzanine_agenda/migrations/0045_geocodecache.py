@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0044_event_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('query', models.TextField()),
+                ('mappable_location', models.CharField(max_length=1024)),
+                ('lat', models.DecimalField(decimal_places=7, max_digits=10, null=True)),
+                ('lon', models.DecimalField(decimal_places=7, max_digits=10, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Geocode cache',
+                'verbose_name_plural': 'Geocode cache',
+            },
+        ),
+    ]
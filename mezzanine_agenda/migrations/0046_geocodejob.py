@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0045_geocodecache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('done', 'done'), ('failed', 'failed')], db_index=True, default='pending', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('location', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='geocode_job', to='mezzanine_agenda.EventLocation')),
+            ],
+            options={
+                'verbose_name': 'Geocode job',
+                'verbose_name_plural': 'Geocode jobs',
+                'ordering': ('created',),
+            },
+        ),
+    ]
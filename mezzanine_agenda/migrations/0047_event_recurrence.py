@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mezzanine_agenda', '0046_geocodejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='recurrence',
+            field=models.TextField(blank=True, help_text='RRULE, RDATE and EXDATE lines (RFC 5545) repeating the event, e.g. RRULE:FREQ=WEEKLY;BYDAY=FR;COUNT=10', verbose_name='recurrence'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='recurrence_end',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='recurrence end'),
+        ),
+    ]
@@ -1,30 +1,38 @@
 from __future__ import unicode_literals
 from future.builtins import str
+from bisect import bisect_left, bisect_right
+from hashlib import sha1
+from urllib.parse import quote
 
 from django.utils import timezone
-from django.db import models
+from django.db import models, router, transaction
 from django.db.models import Q
-from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.http import RFC3986_SUBDELIMS
 from django.utils.translation import ugettext_lazy as _
 from django.utils.text import slugify
 
-from geopy.geocoders import GoogleV3 as GoogleMaps
-from geopy.exc import GeocoderQueryError
-
 from icalendar import Event as IEvent
 
 from mezzanine.conf import settings
 from mezzanine.core.fields import FileField, RichTextField
-from mezzanine.core.models import Displayable, TeamOwnable, RichText, SiteRelated
+from mezzanine.core.models import Displayable, TeamOwnable, RichText, SiteRelated,\
+    wrapped_manager
 from mezzanine.generic.fields import CommentsField, RatingField
 from mezzanine.utils.models import AdminThumbMixin
-from mezzanine.utils.sites import current_site_id
-from mezzanine.utils.models import base_concrete_model
 
 from organization.core.models import TitledSlugged
 
+from mezzanine_agenda.geocoding import GeocodingError, get_geocoder, normalize_query
+from mezzanine_agenda.managers import EventManager
+from mezzanine_agenda.recurrence import add_recurrence, count_occurrences,\
+    get_recurrence_end
+from mezzanine_agenda.utils import site_domain
+
+
+URL_SLUG_PLACEHOLDER = "__event_slug__"
 
 ALIGNMENT_CHOICES = (
     (
@@ -50,6 +58,20 @@ class SubTitle(models.Model):
         abstract = True
 
 
+def translated_attnames(model, name):
+    """
+    Return the attribute names of the field ``name`` of ``model``,
+    followed by the ones of its translations when modeltranslation is
+    used.
+    """
+    field = model._meta.get_field(name)
+    return [field.attname] + [
+        translation.attname for translation in model._meta.fields
+        if getattr(translation, "translated_field", None) is not None and
+        translation.translated_field.name == name
+    ]
+
+
 class Event(Displayable, SubTitle, TeamOwnable, RichText, AdminThumbMixin):
     """
     An event.
@@ -116,14 +138,57 @@ class Event(Displayable, SubTitle, TeamOwnable, RichText, AdminThumbMixin):
     comments = CommentsField(verbose_name=_("Comments"))
     rating = RatingField(verbose_name=_("Rating"))
     rank = models.IntegerField(verbose_name=_('rank'), blank=True, null=True)
+    recurrence = models.TextField(
+        _('recurrence'),
+        blank=True,
+        help_text=_(
+            "RRULE, RDATE and EXDATE lines (RFC 5545) repeating the event, "
+            "e.g. RRULE:FREQ=WEEKLY;BYDAY=FR;COUNT=10"
+        )
+    )
+    recurrence_end = models.DateTimeField(
+        _('recurrence end'),
+        blank=True,
+        null=True,
+        editable=False
+    )
 
     admin_thumb_field = "photo"
 
+    # fields always taken from the parent, and the ones taken from the
+    # parent when empty
+    PARENT_FIELDS = ("title", "user", "status")
+    PARENT_DEFAULT_FIELDS = (
+        "location", "category", "description", "mentions", "content"
+    )
+
+    objects = wrapped_manager(EventManager)
+
     class Meta:
         verbose_name = _("Event")
         verbose_name_plural = _("Events")
         ordering = ("rank", "start",)
         permissions = TeamOwnable.Meta.permissions
+        indexes = [
+            # upcoming / archive date ranges, ``start__gt | end__gt``
+            models.Index(fields=["start", "end"], name="agenda_event_start_end"),
+            models.Index(fields=["end"], name="agenda_event_end"),
+            # default ordering
+            models.Index(fields=["rank", "start"], name="agenda_event_rank_start"),
+            # previous / next top level event, children of a parent
+            models.Index(fields=["parent", "start"], name="agenda_event_parent_start"),
+            models.Index(
+                fields=["location", "start"],
+                name="agenda_event_location_start"
+            ),
+            # published manager
+            models.Index(
+                fields=["status", "publish_date"],
+                name="agenda_event_status_publish"
+            ),
+            # next expiry, see ``cache.next_transition``
+            models.Index(fields=["expiry_date"], name="agenda_event_expiry"),
+        ]
 
     def clean(self):
         """
@@ -134,60 +199,148 @@ class Event(Displayable, SubTitle, TeamOwnable, RichText, AdminThumbMixin):
         if self.end and self.start > self.end:
             raise ValidationError("Start must be sooner than end.")
 
+        if self.recurrence and self.start:
+            try:
+                count = count_occurrences(self.recurrence, self.start)
+            except (ValueError, TypeError) as e:
+                raise ValidationError({"recurrence": str(e)})
+            if count > settings.EVENT_RECURRENCE_MAX_OCCURRENCES:
+                raise ValidationError({"recurrence": _(
+                    "The event can't recur more than %d times."
+                ) % settings.EVENT_RECURRENCE_MAX_OCCURRENCES})
+
     def save(self, *args, **kwargs):
-        super(Event, self).save(*args, **kwargs)
-        # take some values from parent
-        if self.parent is not None:
-            self.title = self.parent.title
-            self.user = self.parent.user
-            self.status = self.parent.status
-            if not self.location:
-                self.location = self.parent.location
-            if not self.description:
-                self.description = self.parent.description
-                self.description_en = self.parent.description_en
-            if not self.category:
-                self.category = self.parent.category
-            if not self.mentions:
-                self.mentions = self.parent.mentions
-                self.mentions_en = self.parent.mentions_en
-            parent_images = self.parent.images.select_related('event').all()
-            for parent_image in parent_images:
-                if not self.images.filter(
-                    file=parent_image.file,
-                    type=parent_image.type
-                ):
-                    parent_image.pk = None
-                    parent_image.save()
-                    parent_image.event = self
-                    parent_image.save()
-            if not self.user:
-                self.user = self.parent.user
-            if not self.status:
-                self.status = self.parent.status
-            if not self.content:
-                self.content = self.parent.content
-                self.content_en = self.parent.content_en
-            if not self.departments.all():
-                parent_departments = self.parent.departments.all()
-                for parent_department in parent_departments:
-                    parent_department.pk = None
-                    parent_department.save()
-                    parent_department.event = self
-                    parent_department.save()
-            if not self.links.all():
-                all_links = self.parent.links.all()
-                for link in all_links:
-                    link.pk = None
-                    link.save()
-                    link.event = self
-                    link.save()
-        super(Event, self).save(*args, **kwargs)
+        """
+        Save the event, taking some values from its parent: a single
+        save, followed by a few bulk queries copying the parent's
+        related rows, in one transaction.
+        """
+        using = kwargs.get("using") or router.db_for_write(Event, instance=self)
+        with transaction.atomic(using=using):
+            adding = self._state.adding
+            if self.parent is not None:
+                self.inherit_fields()
+            self.recurrence_end = get_recurrence_end(self)
+            previous = None
+            if not adding:
+                previous = Event._base_manager.using(using).filter(
+                    pk=self.pk
+                ).values(*self.get_inherited_attnames()).first()
+            super(Event, self).save(*args, **kwargs)
+            # the slug or publish date may have changed
+            self.__dict__.pop("_absolute_url", None)
+            if self.parent is not None:
+                self.inherit_related(adding)
+            if previous and any(getattr(self, attname) != value
+                                for attname, value in previous.items()):
+                self.propagate_to_children(previous)
+
+    def inherit_fields(self):
+        """
+        Copy the ``PARENT_FIELDS`` of the parent, and its
+        ``PARENT_DEFAULT_FIELDS`` that are empty on this event, along
+        with their translations.
+        """
+        for name in self.PARENT_FIELDS:
+            for attname in translated_attnames(Event, name):
+                setattr(self, attname, getattr(self.parent, attname))
+        for name in self.PARENT_DEFAULT_FIELDS:
+            if not getattr(self, Event._meta.get_field(name).attname):
+                for attname in translated_attnames(Event, name):
+                    setattr(self, attname, getattr(self.parent, attname))
+
+    @classmethod
+    def get_inherited_attnames(cls):
+        """
+        Return the attribute names of the fields children take from
+        their parent, including translations.
+        """
+        return [
+            attname
+            for name in cls.PARENT_FIELDS + cls.PARENT_DEFAULT_FIELDS
+            for attname in translated_attnames(cls, name)
+        ]
+
+    def propagate_to_children(self, previous=None):
+        """
+        Push the fields children take from this event to them, with
+        bulk updates of ``EVENT_PROPAGATION_BATCH_SIZE`` children.
+        ``PARENT_DEFAULT_FIELDS`` only replace empty values, or the
+        values equal to this event's ``previous`` ones, i.e. inherited
+        from it. Return the number of updated children.
+        """
+        from mezzanine_agenda.cache import bump_version
+        previous = previous or {}
+        fields = [
+            (attname, name in self.PARENT_DEFAULT_FIELDS)
+            for name in self.PARENT_FIELDS + self.PARENT_DEFAULT_FIELDS
+            for attname in translated_attnames(Event, name)
+        ]
+        attnames = [attname for attname, default in fields]
+        children = self.children.all().only("pk", *attnames).order_by("pk")
+        updated, now, count = [], timezone.now(), 0
+        for child in children.iterator():
+            changed = False
+            for attname, default in fields:
+                value = getattr(child, attname)
+                if default and value and value != previous.get(attname):
+                    continue
+                if value != getattr(self, attname):
+                    setattr(child, attname, getattr(self, attname))
+                    changed = True
+            if changed:
+                child.updated = now
+                updated.append(child)
+            if len(updated) == settings.EVENT_PROPAGATION_BATCH_SIZE:
+                Event._base_manager.bulk_update(updated, attnames + ["updated"])
+                count += len(updated)
+                updated = []
+        if updated:
+            Event._base_manager.bulk_update(updated, attnames + ["updated"])
+            count += len(updated)
+        if count:
+            # bulk updates don't send the signals invalidating the cache
+            bump_version()
+        return count
+
+    def inherit_related(self, adding=False):
+        """
+        Copy the images of the parent this event doesn't have, and its
+        departments and links if this event has none, with one query
+        per relation to read the existing rows and one to insert the
+        copies.
+        """
+        def copy_rows(name, rows):
+            related = getattr(self, name)
+            for row in rows:
+                row.pk = None
+                setattr(row, related.field.name, self)
+            if rows:
+                related.model.objects.bulk_create(rows)
+
+        def image_key(file, type):
+            return str(file), type
+
+        parent_images = list(self.parent.images.all())
+        if parent_images and not adding:
+            existing = set(
+                image_key(*values)
+                for values in self.images.values_list("file", "type")
+            )
+            parent_images = [
+                image for image in parent_images
+                if image_key(image.serializable_value("file"),
+                             image.serializable_value("type")) not in existing
+            ]
+        copy_rows("images", parent_images)
+        for name in ("departments", "links"):
+            if adding or not getattr(self, name).exists():
+                copy_rows(name, list(getattr(self.parent, name).all()))
 
     def update(self, *args, **kwargs):
         super(Event, self).save(*args, **kwargs)
 
-    def get_absolute_url(self):
+    def get_url_name_kwargs(self):
         """
         URLs for events can either be just their slug, or prefixed
         with a portion of the post's publish date, controlled by the
@@ -211,16 +364,30 @@ class Event(Displayable, SubTitle, TeamOwnable, RichText, AdminThumbMixin):
                 kwargs[date_part] = date_value
                 if date_part == settings.EVENT_URLS_DATE_FORMAT:
                     break
-        return reverse(url_name, kwargs=kwargs)
+        return url_name, kwargs
+
+    def get_absolute_url(self):
+        """
+        Reverse the URL returned by ``get_url_name_kwargs``, once per
+        instance, see also ``prime_absolute_urls``.
+        """
+        url = self.__dict__.get("_absolute_url")
+        if url is None:
+            url_name, kwargs = self.get_url_name_kwargs()
+            url = self._absolute_url = reverse(url_name, kwargs=kwargs)
+        return url
 
-    def get_icalendar_event(self):
+    def get_icalendar_event(self, domain=None):
         """
-        Builds an icalendar.event object from event data.
+        Builds an icalendar.event object from event data. ``domain``
+        defaults to the current site's domain.
         """
+        if domain is None:
+            domain = site_domain()
         icalendar_event = IEvent()
         icalendar_event.add('summary'.encode("utf-8"), self.title)
         icalendar_event.add('url', 'http://{domain}{url}'.format(
-            domain=Site.objects.get(id=current_site_id()).domain,
+            domain=domain,
             url=self.get_absolute_url(),
         ))
         if self.location:
@@ -231,31 +398,41 @@ class Event(Displayable, SubTitle, TeamOwnable, RichText, AdminThumbMixin):
             icalendar_event.add('dtend', self.end)
         icalendar_event['uid'.encode("utf-8")] = "event-{id}@{domain}".format(
             id=self.id,
-            domain=Site.objects.get(id=current_site_id()).domain,
+            domain=domain,
         ).encode("utf-8")
+        if self.recurrence:
+            add_recurrence(icalendar_event, self)
         return icalendar_event
 
+    def get_start_date_neighbours(self, for_user=None):
+        """
+        Return the previous and next published top-level events by
+        start date, located in the in-process ``start_date_index`` and
+        fetched with a single query. The result is memoized on the
+        instance.
+        """
+        staff = bool(for_user is not None and for_user.is_staff)
+        neighbours = self.__dict__.setdefault("_start_date_neighbours", {})
+        if staff not in neighbours:
+            from mezzanine_agenda.cache import start_date_index
+            index = start_date_index(staff)
+            lower = bisect_left(index, (self.start,))
+            upper = bisect_right(index, (self.start, float("inf")))
+            ids = (
+                index[lower - 1][1] if lower > 0 else None,
+                index[upper][1] if upper < len(index) else None,
+            )
+            events = Event.objects.in_bulk([id for id in ids if id is not None])
+            neighbours[staff] = tuple(events.get(id) for id in ids)
+        return neighbours[staff]
+
     def _get_next_or_previous_by_start_date(self, is_next, **kwargs):
         """
         Retrieves next or previous object by start date. We implement
         our own version instead of Django's so we can hook into the
-        published manager and concrete subclasses.
-        """
-        arg = "start__gt" if is_next else "start__lt"
-        order = "start" if is_next else "-start"
-        lookup = {arg: self.start}
-        concrete_model = base_concrete_model(Displayable, self)
-        try:
-            queryset = concrete_model.objects.published
-        except AttributeError:
-            queryset = concrete_model.objects.all
-        try:
-            return queryset(**kwargs)\
-                .filter(**lookup)\
-                .filter(parent__isnull=True)\
-                .order_by(order)[0]
-        except IndexError:
-            pass
+        published manager and skip child events.
+        """
+        return self.get_start_date_neighbours(**kwargs)[1 if is_next else 0]
 
     def get_next_by_start_date(self, **kwargs):
         """
@@ -275,13 +452,21 @@ class Event(Displayable, SubTitle, TeamOwnable, RichText, AdminThumbMixin):
         else:
             return 'l j F'
 
-    @property
+    # ``is_free``, ``has_vel`` and ``vel_url`` are replaced by the
+    # annotations of ``Event.objects.with_booking_state()`` when present.
+
+    @cached_property
     def has_vel(self):
-        return self.links.filter(link_type__slug='vel').count()
+        return self.links.filter(link_type__slug='vel').exists()
+
+    @cached_property
+    def vel_url(self):
+        link = self.links.filter(link_type__slug='vel').first()
+        return link.url if link else None
 
     @property
     def vel(self):
-        return self.links.filter(link_type__slug='vel').first().url
+        return self.vel_url
 
     @property
     def has_shop(self):
@@ -291,9 +476,9 @@ class Event(Displayable, SubTitle, TeamOwnable, RichText, AdminThumbMixin):
     def is_archived(self):
         return self.end and self.end < timezone.now()
 
-    @property
+    @cached_property
     def is_free(self):
-        return self.prices.filter(value=0.0).count()
+        return self.prices.filter(value=0.0).exists()
 
     @property
     def reserve_button(self):
@@ -314,6 +499,33 @@ class Event(Displayable, SubTitle, TeamOwnable, RichText, AdminThumbMixin):
         return button
 
 
+def prime_absolute_urls(events):
+    """
+    Memoize the URL of each of ``events``, reversing the URL pattern
+    once per distinct publish date prefix, with a placeholder slug
+    which is then replaced with the quoted slug of each event. Return
+    ``events``.
+    """
+    templates = {}
+    for event in events:
+        if getattr(event, "is_occurrence", False):
+            event = event.event
+        if "_absolute_url" in event.__dict__:
+            continue
+        url_name, kwargs = event.get_url_name_kwargs()
+        slug = kwargs.pop("slug")
+        key = (url_name,) + tuple(sorted(kwargs.items()))
+        if key not in templates:
+            kwargs["slug"] = URL_SLUG_PLACEHOLDER
+            url = reverse(url_name, kwargs=kwargs)
+            templates[key] = url.rpartition(URL_SLUG_PLACEHOLDER)[::2]
+        prefix, suffix = templates[key]
+        event._absolute_url = "%s%s%s" % (
+            prefix, quote(slug, safe=RFC3986_SUBDELIMS + "/~:@"), suffix
+        )
+    return events
+
+
 class EventLocation(TitledSlugged):
     """
     A Event Location.
@@ -366,31 +578,43 @@ class EventLocation(TitledSlugged):
             raise ValidationError("Latitude required if specifying longitude.")
 
         if not (self.lat and self.lon) and not self.mappable_location:
-            self.mappable_location = self.address\
-                .replace("\n", " ")\
-                .replace('\r', ' ') + ", " + self.postal_code + " " + self.city
-
-        if self.mappable_location and not (self.lat and self.lon):  # location should always override lat/long if set  # noqa: E501
-            g = GoogleMaps(
-                api_key=settings.GOOGLE_API_KEY,
-                domain=settings.EVENT_GOOGLE_MAPS_DOMAIN
-            )
+            self.mappable_location = self.get_default_mappable_location()
+
+        self._geocode_later = False
+        if self.mappable_location and not (self.lat and self.lon) and \
+                settings.EVENT_GEOCODE_ASYNC:
+            result = GeocodeCache.lookup(self.mappable_location)
+            if result is None:
+                # geocoded by the agenda_geocode command
+                self._geocode_later = True
+            else:
+                self.mappable_location, self.lat, self.lon = result
+        elif self.mappable_location and not (self.lat and self.lon):  # location should always override lat/long if set  # noqa: E501
+            message = "The mappable location you specified could not be found on {service}: \"{error}\" Try changing the mappable location, removing any business names, or leaving mappable location blank and using coordinates from getlatlon.com."  # noqa: E501
             try:
-                mappable_location, (lat, lon) = g.geocode(self.mappable_location)
-            except GeocoderQueryError as e:
-                raise ValidationError("The mappable location you specified could not be found on {service}: \"{error}\" Try changing the mappable location, removing any business names, or leaving mappable location blank and using coordinates from getlatlon.com.".format(service="Google Maps", error=e))  # noqa: E501
-            except ValueError as e:
-                raise ValidationError("The mappable location you specified could not be found on {service}: \"{error}\" Try changing the mappable location, removing any business names, or leaving mappable location blank and using coordinates from getlatlon.com.".format(service="Google Maps", error=e.message))  # noqa: E501
-            self.mappable_location = mappable_location
-            self.lat = lat
-            self.lon = lon
-            print("self.lat", self.lat)
-            print("self.lon", self.lon)
-            print("self.mappable_location", self.mappable_location)
+                result = GeocodeCache.geocode(self.mappable_location)
+            except GeocodingError as e:
+                raise ValidationError(message.format(service="Google Maps", error=e))
+            if result is None:
+                raise ValidationError(message.format(
+                    service="Google Maps",
+                    error=self.mappable_location
+                ))
+            self.mappable_location, self.lat, self.lon = result
 
     def save(self, *args, **kwargs):
         self.clean()
         super(EventLocation, self).save(*args, **kwargs)
+        if self._geocode_later:
+            GeocodeJob.enqueue(self)
+
+    def get_default_mappable_location(self):
+        """
+        Return the location to geocode built from the address.
+        """
+        return self.address\
+            .replace("\n", " ")\
+            .replace('\r', ' ') + ", " + self.postal_code + " " + self.city
 
     def __str__(self):
         if self.room:
@@ -402,6 +626,137 @@ class EventLocation(TitledSlugged):
         return reverse("event_list_location", kwargs={"location": self.slug})
 
 
+class GeocodeCache(models.Model):
+    """
+    Coordinates of a mappable location, as found by the geocoder.
+    """
+
+    key = models.CharField(max_length=40, unique=True)
+    query = models.TextField()
+    mappable_location = models.CharField(max_length=1024)
+    lat = models.DecimalField(max_digits=10, decimal_places=7, null=True)
+    lon = models.DecimalField(max_digits=10, decimal_places=7, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Geocode cache")
+        verbose_name_plural = _("Geocode cache")
+
+    def __str__(self):
+        return self.query
+
+    @staticmethod
+    def get_key(query):
+        """
+        Return the key of the normalized ``query``.
+        """
+        return sha1(normalize_query(query).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def with_coordinates(cls):
+        """
+        Return the cached results having coordinates. Others, such as
+        the ones of ``DummyGeocoder``, aren't used so that addresses
+        are geocoded again by a real backend.
+        """
+        return cls.objects.filter(lat__isnull=False, lon__isnull=False)
+
+    @classmethod
+    def lookup(cls, query):
+        """
+        Return the cached ``(mappable_location, lat, lon)`` of an
+        address, or ``None`` if it hasn't been geocoded yet.
+        """
+        cached = cls.with_coordinates().filter(key=cls.get_key(query)).first()
+        if cached is not None:
+            return cached.mappable_location, cached.lat, cached.lon
+
+    @classmethod
+    def store(cls, query, result):
+        """
+        Cache the ``(mappable_location, lat, lon)`` found for an address
+        and return it. Results without coordinates aren't cached.
+        """
+        mappable_location, lat, lon = result
+        if lat is None or lon is None:
+            return result
+        cached, created = cls.objects.update_or_create(
+            key=cls.get_key(query),
+            defaults={
+                "query": normalize_query(query),
+                "mappable_location": mappable_location,
+                "lat": lat,
+                "lon": lon,
+            }
+        )
+        return cached.mappable_location, cached.lat, cached.lon
+
+    @classmethod
+    def geocode(cls, query):
+        """
+        Return the ``(mappable_location, lat, lon)`` of an address, read
+        from the cache or found by the ``EVENT_GEOCODER`` backend and
+        cached. Return ``None`` if the address can't be found.
+        """
+        result = cls.lookup(query)
+        if result is None:
+            result = get_geocoder().geocode(normalize_query(query))
+            if result is not None:
+                result = cls.store(query, result)
+        return result
+
+
+class GeocodeJob(models.Model):
+    """
+    Pending geocoding of an event location, saved with
+    ``EVENT_GEOCODE_ASYNC`` and processed by the ``agenda_geocode``
+    command.
+    """
+
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, _("pending")),
+        (DONE, _("done")),
+        (FAILED, _("failed")),
+    )
+
+    location = models.OneToOneField(
+        EventLocation,
+        on_delete=models.CASCADE,
+        related_name="geocode_job"
+    )
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+        db_index=True
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Geocode job")
+        verbose_name_plural = _("Geocode jobs")
+        ordering = ("created",)
+
+    def __str__(self):
+        return "%s (%s)" % (self.location, self.status)
+
+    @classmethod
+    def enqueue(cls, location):
+        """
+        Schedule the geocoding of ``location``.
+        """
+        cls.objects.update_or_create(
+            location=location,
+            defaults={"status": cls.PENDING, "attempts": 0, "error": ""}
+        )
+
+
 class EventPrice(models.Model):
     """(EventPrice description)"""
 
@@ -0,0 +1,352 @@
+"""
+Recurring events, whose ``recurrence`` field holds RRULE, RDATE and
+EXDATE lines (RFC 5545). Their occurrences aren't stored: they're
+expanded for the window being displayed, as ``Occurrence`` objects
+standing for the event at another date.
+
+Rules are evaluated in wall clock time of ``EVENT_TIME_ZONE``, so that
+a weekly show at 8pm stays at 8pm across DST changes.
+"""
+from __future__ import unicode_literals
+
+from calendar import monthrange
+from datetime import datetime, time, timedelta
+from itertools import islice, takewhile
+
+import pytz
+from dateutil.parser import parse as parse_date
+from dateutil.rrule import YEARLY, rrule, rrulestr, weekdays
+from django.db.models import Q
+from django.utils import timezone
+from icalendar import Timezone, TimezoneDaylight, TimezoneStandard, vRecur
+
+from mezzanine.conf import settings
+
+from mezzanine_agenda.utils import event_timezone
+
+
+def _to_local(value, tz):
+    if timezone.is_aware(value):
+        return timezone.make_naive(value, tz)
+    return value
+
+
+def _from_local(value, tz):
+    if settings.USE_TZ:
+        return timezone.make_aware(value, tz)
+    return value
+
+
+def get_rruleset(recurrence, start, tz=None):
+    """
+    Parse ``recurrence`` lines into a ``dateutil.rrule.rruleset`` of
+    naive wall clock datetimes starting at ``start``. Raise
+    ``ValueError`` if the lines are invalid.
+    """
+    tz = tz or event_timezone()
+    return rrulestr(
+        recurrence.strip(),
+        dtstart=_to_local(start, tz),
+        forceset=True,
+        ignoretz=True,
+        unfold=True,
+    )
+
+
+def recurrence_lines(recurrence):
+    """
+    Return the lines of ``recurrence``, unfolded as ``get_rruleset``
+    does: a line starting with a space continues the previous one.
+    """
+    lines = []
+    for line in recurrence.strip().splitlines():
+        line = line.rstrip()
+        if not line:
+            continue
+        if lines and line[0] == " ":
+            lines[-1] += line[1:]
+        else:
+            lines.append(line)
+    return lines
+
+
+def is_bounded(recurrence):
+    """
+    Whether every RRULE of ``recurrence`` ends, with COUNT or UNTIL.
+    """
+    for line in recurrence_lines(recurrence.upper()):
+        if line.startswith("RRULE:") and \
+                "COUNT=" not in line and "UNTIL=" not in line:
+            return False
+    return True
+
+
+def count_occurrences(recurrence, start, tz=None):
+    """
+    Return the number of occurrences of ``recurrence`` from ``start``,
+    within ``EVENT_RECURRENCE_HORIZON`` days for endless rules, and
+    counting at most one more than ``EVENT_RECURRENCE_MAX_OCCURRENCES``.
+    """
+    tz = tz or event_timezone()
+    maximum = settings.EVENT_RECURRENCE_MAX_OCCURRENCES
+    dates = get_rruleset(recurrence, start, tz)
+    if not is_bounded(recurrence):
+        horizon = _to_local(start, tz) + timedelta(
+            days=settings.EVENT_RECURRENCE_HORIZON
+        )
+        dates = takewhile(lambda date: date <= horizon, dates)
+    return sum(1 for date in islice(dates, maximum + 1))
+
+
+def get_recurrence_end(event):
+    """
+    Return the end of the last occurrence of a recurring event, or
+    ``None`` if it recurs forever, has more than
+    ``EVENT_RECURRENCE_MAX_OCCURRENCES`` occurrences or doesn't recur.
+    """
+    if not event.recurrence or not is_bounded(event.recurrence):
+        return None
+    tz = event_timezone()
+    maximum = settings.EVENT_RECURRENCE_MAX_OCCURRENCES
+    last = None
+    for i, last in enumerate(get_rruleset(event.recurrence, event.start, tz)):
+        if i == maximum:
+            return None
+    if last is None:
+        return event.end or event.start
+    return _from_local(last, tz) + _duration(event)
+
+
+def _duration(event):
+    if event.end and event.end > event.start:
+        return event.end - event.start
+    return timedelta(0)
+
+
+def exclude_dates(recurrence, dates, tz=None):
+    """
+    Return ``recurrence`` with an EXDATE line excluding ``dates``.
+    """
+    tz = tz or event_timezone()
+    return "%s\nEXDATE:%s" % (recurrence.strip(), ",".join(
+        _to_local(date, tz).strftime("%Y%m%dT%H%M%S") for date in dates
+    ))
+
+
+class Occurrence(object):
+    """
+    An event at one of the dates of its recurrence. Attributes other
+    than ``start``, ``end`` and those depending on them are the event's
+    ones.
+    """
+
+    is_occurrence = True
+
+    def __init__(self, event, start):
+        self.event = event
+        self.start = start
+        self.end = start + _duration(event) if event.end else None
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name == "event":
+            raise AttributeError(name)
+        return getattr(self.event, name)
+
+    @property
+    def is_archived(self):
+        return self.end and self.end < timezone.now()
+
+    @property
+    def reserve_button(self):
+        # Evaluated on the occurrence, so that it depends on its own
+        # ``is_archived``.
+        return type(self.event).reserve_button.fget(self)
+
+    def __eq__(self, other):
+        return isinstance(other, Occurrence) and \
+            (self.event.pk, self.start) == (other.event.pk, other.start)
+
+    def __hash__(self):
+        return hash((self.event.pk, self.start))
+
+    def __repr__(self):
+        return "<Occurrence: %s at %s>" % (self.event, self.start)
+
+    def __str__(self):
+        return str(self.event)
+
+
+def event_occurrences(event, lower, upper):
+    """
+    Return the ``Occurrence`` objects of a recurring event ongoing
+    between ``lower`` and ``upper``, other than the event itself.
+    """
+    if not event.recurrence:
+        return []
+    tz = event_timezone()
+    duration = _duration(event)
+    dates = get_rruleset(event.recurrence, event.start, tz).xafter(
+        _to_local(lower - duration, tz),
+        count=settings.EVENT_RECURRENCE_MAX_OCCURRENCES,
+        inc=True
+    )
+    occurrences = []
+    for date in takewhile(lambda date: date <= _to_local(upper, tz), dates):
+        start = _from_local(date, tz)
+        if start != event.start and start + duration >= lower:
+            occurrences.append(Occurrence(event, start))
+    return occurrences
+
+
+def next_boundary(event, now):
+    """
+    Return the first date after ``now`` at which an occurrence of a
+    recurring event starts or ends, or ``None`` if there's none.
+    """
+    if not event.recurrence:
+        return None
+    tz = event_timezone()
+    duration = _duration(event)
+    rules = get_rruleset(event.recurrence, event.start, tz)
+    boundaries = []
+    ongoing = rules.after(_to_local(now - duration, tz))
+    if ongoing is not None:
+        end = _from_local(ongoing, tz) + duration
+        if end > now:
+            boundaries.append(end)
+    following = rules.after(_to_local(now, tz))
+    if following is not None:
+        boundaries.append(_from_local(following, tz))
+    return min(boundaries) if boundaries else None
+
+
+def recurring_between(lower, upper=None):
+    """
+    Return a ``Q`` object matching the recurring events which may have
+    occurrences between ``lower`` and ``upper``, to be combined with
+    the filter of the events of a date window.
+    """
+    query = ~Q(recurrence="") & (
+        Q(recurrence_end__isnull=True) | Q(recurrence_end__gt=lower)
+    )
+    if upper is not None:
+        query &= Q(start__lt=upper)
+    return query
+
+
+def expand_occurrences(events, lower, upper=None, keep_past=False):
+    """
+    Return ``events`` along with the occurrences of the recurring ones
+    between ``lower`` and ``upper``, ordered by start date. ``upper``
+    defaults to ``EVENT_RECURRENCE_HORIZON`` days after ``lower``. A
+    recurring event which started before ``lower`` is only kept when
+    it's still ongoing, or with ``keep_past``.
+    """
+    if upper is None:
+        upper = lower + timedelta(days=settings.EVENT_RECURRENCE_HORIZON)
+    expanded = []
+    for event in events:
+        if not event.recurrence:
+            expanded.append(event)
+            continue
+        if keep_past or event.start >= lower or (event.end and event.end > lower):
+            expanded.append(event)
+        expanded.extend(event_occurrences(event, lower, upper))
+    return sorted(expanded, key=lambda event: event.start)
+
+
+def _nth_weekday(day):
+    """
+    Return the weekday of ``day`` in its week of the month, counted
+    from the end for the last one, e.g. ``SU(-1)``.
+    """
+    if day.day + 7 > monthrange(day.year, day.month)[1]:
+        return weekdays[day.weekday()](-1)
+    return weekdays[day.weekday()]((day.day - 1) // 7 + 1)
+
+
+def make_vtimezone(tz, year=None):
+    """
+    Return a VTIMEZONE component describing ``tz`` with yearly rules
+    deduced from its transitions in ``year``, the current one by
+    default, so that the TZID of recurring events can be resolved by
+    clients without a time zone database.
+    """
+    year = year or timezone.now().year
+    vtimezone = Timezone()
+    vtimezone.add("tzid", str(tz))
+    transitions = getattr(tz, "_utc_transition_times", [])
+    infos = getattr(tz, "_transition_info", [])
+    for i, when in enumerate(transitions):
+        if i == 0 or when.year != year:
+            continue
+        offset_from = infos[i - 1][0]
+        offset_to, dst, name = infos[i]
+        local = when + offset_from
+        weekday = _nth_weekday(local)
+        component = TimezoneDaylight() if dst else TimezoneStandard()
+        component.add("tzname", name)
+        component.add("dtstart", rrule(
+            YEARLY, dtstart=local.replace(year=1970, month=1, day=1),
+            bymonth=local.month, byweekday=weekday, count=1
+        )[0])
+        component.add("tzoffsetfrom", offset_from)
+        component.add("tzoffsetto", offset_to)
+        component.add("rrule", {
+            "freq": "yearly",
+            "bymonth": local.month,
+            "byday": "%d%s" % (weekday.n, weekdays[weekday.weekday]),
+        })
+        vtimezone.add_component(component)
+    if not vtimezone.subcomponents:
+        now = timezone.now().astimezone(tz)
+        component = TimezoneStandard()
+        component.add("tzname", now.tzname())
+        component.add("dtstart", datetime(1970, 1, 1))
+        component.add("tzoffsetfrom", now.utcoffset())
+        component.add("tzoffsetto", now.utcoffset())
+        vtimezone.add_component(component)
+    return vtimezone
+
+
+def _until_utc(rule, tz):
+    """
+    Express the UNTIL of ``rule`` in UTC, as required when the start
+    of the event has a TZID.
+    """
+    until = rule.get("UNTIL")
+    if until:
+        value = until[0]
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, time(23, 59, 59))
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, tz)
+        rule["UNTIL"] = [value.astimezone(pytz.utc)]
+    return rule
+
+
+def add_recurrence(icalendar_event, event):
+    """
+    Add the RRULE, RDATE and EXDATE properties of a recurring event to
+    its VEVENT, whose start and end are then expressed in
+    ``EVENT_TIME_ZONE`` so that clients repeat it in wall clock time.
+    """
+    tz = event_timezone()
+    for name in ("dtstart", "dtend"):
+        value = getattr(event, name[2:])
+        if value is not None and timezone.is_aware(value):
+            del icalendar_event[name]
+            icalendar_event.add(name, value.astimezone(tz))
+    for line in recurrence_lines(event.recurrence):
+        name, separator, value = line.partition(":")
+        name = name.split(";")[0].upper()
+        if name == "RRULE":
+            rule = vRecur.from_ical(value)
+            if timezone.is_aware(event.start):
+                rule = _until_utc(rule, tz)
+            icalendar_event.add("rrule", rule)
+        elif name in ("RDATE", "EXDATE"):
+            icalendar_event.add(name.lower(), [
+                _from_local(parse_date(date, ignoretz=True), tz)
+                for date in value.split(",") if date.strip()
+            ])
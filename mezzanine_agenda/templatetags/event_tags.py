@@ -2,22 +2,24 @@
 
 from __future__ import unicode_literals
 
-from django.contrib.sites.models import Site
 from django.urls import reverse
-from django.db.models import Count, Q
+from django.db.models import Count, Max, Min, Q
+from django.db.models.functions import TruncMonth
 from django.utils import timezone
 from django.utils.http import urlquote as quote
 from django.utils.safestring import mark_safe
 
-from mezzanine_agenda.models import Event, EventLocation
+from mezzanine_agenda.models import Event, EventLocation, prime_absolute_urls
 from mezzanine.conf import settings
 from mezzanine.generic.models import Keyword
 from mezzanine.template import Library
 from mezzanine.utils.models import get_user_model
-from mezzanine.utils.sites import current_site_id
-from mezzanine_agenda.utils import sign_url
-
-import pytz
+from mezzanine_agenda.cache import cache_result, cache_tag, get_excluded_keywords
+from mezzanine_agenda.maps import static_map_url
+from mezzanine_agenda.recurrence import Occurrence, event_occurrences,\
+    expand_occurrences, recurring_between
+from mezzanine_agenda.utils import calendar_month_weeks, count_events_by_week, \
+    event_timezone, group_events_by_day, localize, site_domain
 
 from time import strptime
 from datetime import datetime, timedelta
@@ -29,29 +31,44 @@ register = Library()
 
 
 @register.as_tag
+@cache_result("event_months")
 def event_months(*args):
     """
-    Put a list of dates for events into the template context.
+    Put a list of dates for events into the template context, with the
+    number of events starting in each month. Occurrences of recurring
+    events count up to ``EVENT_RECURRENCE_HORIZON`` days after now, or
+    after their first date when it's later.
     """
-    if settings.EVENT_TIME_ZONE != "":
-        app_timezone = pytz.timezone(settings.EVENT_TIME_ZONE)
-    else:
-        app_timezone = timezone.get_default_timezone()
-    dates = Event.objects.published().values_list("start", flat=True)
-    correct_timezone_dates = [timezone.make_naive(date, app_timezone) for date in dates]
-    date_dicts = [
-        {"date": datetime(date.year, date.month, 1)} for date in correct_timezone_dates
+    app_timezone = event_timezone()
+    events = Event.objects.published()
+    months = events.filter(recurrence="").annotate(
+        month=TruncMonth("start", tzinfo=app_timezone)
+    ).values("month").annotate(event_count=Count("id")).order_by("month")
+    counts = {}
+    for month in months:
+        date = month["month"]
+        if timezone.is_aware(date):
+            date = timezone.make_naive(date, app_timezone)
+        counts[date] = month["event_count"]
+    now = timezone.now()
+    for event in events.exclude(recurrence=""):
+        horizon = max(now, event.start) + timedelta(
+            days=settings.EVENT_RECURRENCE_HORIZON
+        )
+        for occurrence in [event] + event_occurrences(event, event.start, horizon):
+            start = occurrence.start
+            if timezone.is_aware(start):
+                start = timezone.make_naive(start, app_timezone)
+            date = datetime(start.year, start.month, 1)
+            counts[date] = counts.get(date, 0) + 1
+    return [
+        {"date": date, "event_count": counts[date]}
+        for date in sorted(counts)
     ]
-    month_dicts = []
-    for date_dict in date_dicts:
-        if date_dict not in month_dicts:
-            month_dicts.append(date_dict)
-    for i, date_dict in enumerate(month_dicts):
-        month_dicts[i]["event_count"] = date_dicts.count(date_dict)
-    return month_dicts
 
 
 @register.as_tag
+@cache_result("event_locations")
 def event_locations(*args):
     """
     Put a list of locations for events into the template context.
@@ -62,6 +79,7 @@ def event_locations(*args):
 
 
 @register.as_tag
+@cache_result("event_authors")
 def event_authors(*args):
     """
     Put a list of authors (users) for events into the template context.
@@ -71,12 +89,67 @@ def event_authors(*args):
     return list(authors.annotate(event_count=Count("events")))
 
 
+def _id_or(value, *fields):
+    """
+    Match objects whose id, when ``value`` is a number, or one of the
+    given fields equals ``value``.
+    """
+    query = Q()
+    for field in fields:
+        query |= Q(**{field: value})
+    if str(value).isdigit():
+        query |= Q(id=value)
+    return query
+
+
+@cache_tag("filter_events")
+def _filter_events(upcoming, limit, tag, username, location):
+    """
+    Return the ``limit`` upcoming or recent events, filtered in a single
+    query by keyword, author and location given by id or name.
+    """
+    events = Event.objects.published().select_related("user")
+    now = timezone.now()
+    if upcoming:
+        # Get upcoming events/ongoing events
+        events = events.upcoming(now).order_by('start')
+        window = (now, None)
+    else:
+        window = (now - timedelta(days=settings.EVENT_RECURRENCE_HORIZON), now)
+        events = events.filter(
+            Q(end__lt=now) | recurring_between(*window)
+        ).order_by('-start')
+    if tag is not None:
+        keywords = Keyword.objects.filter(_id_or(tag, "title", "slug"))
+        # an event with several of the keywords is joined once per keyword
+        events = events.filter(keywords__keyword__in=keywords).distinct()
+    if location is not None:
+        locations = EventLocation.objects.filter(_id_or(location, "title", "slug"))
+        events = events.filter(location__in=locations)
+    if username is not None:
+        events = events.filter(user__in=User.objects.filter(
+            _id_or(username, "username")
+        ))
+    limit = int(limit)
+    # recurring events are expanded to their occurrences in the window
+    events = expand_occurrences(
+        list(events.filter(recurrence="")[:limit]) +
+        list(events.exclude(recurrence="")),
+        *window
+    )
+    if not upcoming:
+        events = [event for event in reversed(events)
+                  if event.end is not None and event.end < now]
+    return prime_absolute_urls(events[:limit])
+
+
 @register.as_tag
 def recent_events(limit=5, tag=None, username=None, location=None):
     """
     Put a list of recent events into the template
-    context. A tag title or slug, location title or slug or author's
-    username can also be specified to filter the recent events returned.
+    context. A tag id, title or slug, location id, title or slug or
+    author's id or username can also be specified to filter the recent
+    events returned.
 
     Usage::
 
@@ -86,36 +159,16 @@ def recent_events(limit=5, tag=None, username=None, location=None):
         {% recent_events 5 username=admin as recent_pevents %}
 
     """
-    events = Event.objects.published().select_related("user").order_by('-start')
-    events = events.filter(end__lt=datetime.now())
-    title_or_slug = lambda s: Q(title=s) | Q(slug=s)  # noqa: E731
-    if tag is not None:
-        try:
-            tag = Keyword.objects.get(title_or_slug(tag))
-            events = events.filter(keywords__keyword=tag)
-        except Keyword.DoesNotExist:
-            return []
-    if location is not None:
-        try:
-            location = EventLocation.objects.get(title_or_slug(location))
-            events = events.filter(location=location)
-        except EventLocation.DoesNotExist:
-            return []
-    if username is not None:
-        try:
-            author = User.objects.get(username=username)
-            events = events.filter(user=author)
-        except User.DoesNotExist:
-            return []
-    return list(events[:limit])
+    return _filter_events(False, limit, tag, username, location)
 
 
 @register.as_tag
 def upcoming_events(limit=5, tag=None, username=None, location=None):
     """
     Put a list of upcoming events into the template
-    context. A tag title or slug, location title or slug or author's
-    username can also be specified to filter the upcoming events returned.
+    context. A tag id, title or slug, location id, title or slug or
+    author's id or username can also be specified to filter the upcoming
+    events returned.
 
     Usage::
 
@@ -125,39 +178,14 @@ def upcoming_events(limit=5, tag=None, username=None, location=None):
         {% upcoming_events 5 username=admin as upcoming_events %}
 
     """
-    events = Event.objects.published().select_related("user").order_by('start')
-    # Get upcoming events/ongoing events
-    events = events.filter(Q(start__gt=datetime.now()) | Q(end__gt=datetime.now()))
-    title_or_slug = lambda s: Q(title=s) | Q(slug=s)  # noqa: E731
-    if tag is not None:
-        try:
-            tag = Keyword.objects.get(title_or_slug(tag))
-            events = events.filter(keywords__keyword=tag)
-        except Keyword.DoesNotExist:
-            return []
-    if location is not None:
-        try:
-            location = EventLocation.objects.get(title_or_slug(location))
-            events = events.filter(location=location)
-        except EventLocation.DoesNotExist:
-            return []
-    if username is not None:
-        try:
-            author = User.objects.get(username=username)
-            events = events.filter(user=author)
-        except User.DoesNotExist:
-            return []
-    return list(events[:limit])
+    return _filter_events(True, limit, tag, username, location)
 
 
 def _get_utc(datetime):
     """
     Convert datetime object to be timezone aware and in UTC.
     """
-    if settings.EVENT_TIME_ZONE != "":
-        app_timezone = pytz.timezone(settings.EVENT_TIME_ZONE)
-    else:
-        app_timezone = timezone.get_default_timezone()
+    app_timezone = event_timezone()
 
     # make the datetime aware
     if timezone.is_naive(datetime):
@@ -174,7 +202,7 @@ def google_calendar_url(event):
     """
     Generates a link to add the event to your google calendar.
     """
-    if not isinstance(event, Event):
+    if not isinstance(event, (Event, Occurrence)):
         return ''
     title = quote(event.title)
     start_date = _get_utc(event.start).strftime("%Y%m%dT%H%M%SZ")
@@ -182,7 +210,7 @@ def google_calendar_url(event):
         end_date = _get_utc(event.end).strftime("%Y%m%dT%H%M%SZ")
     else:
         end_date = start_date
-    url = Site.objects.get(id=current_site_id()).domain + event.get_absolute_url()
+    url = site_domain() + event.get_absolute_url()
     if event.location and event.location.mappable_location:
         location = quote(event.location.mappable_location)
     else:
@@ -195,11 +223,10 @@ def google_nav_url(obj):
     """
     Generates a link to get directions to an event or location with google maps.
     """
-    if isinstance(obj, Event) and obj.location and obj.location.mappable_location:
-        location = quote(obj.location.mappable_location)
-    elif isinstance(obj, EventLocation) and \
-            obj.location and \
+    if isinstance(obj, (Event, Occurrence)) and obj.location and \
             obj.location.mappable_location:
+        location = quote(obj.location.mappable_location)
+    elif isinstance(obj, EventLocation) and obj.mappable_location:
         location = quote(obj.mappable_location)
     else:
         return ''
@@ -215,30 +242,18 @@ def google_static_map(obj, width, height, zoom):
     """
     Generates a static google map for the event location.
     """
-    if isinstance(obj, Event) and obj.location and obj.location.mappable_location:
-        location = quote(obj.location.mappable_location)
-        marker = quote('{:.6},{:.6}'.format(obj.location.lat, obj.location.lon))
-    elif isinstance(obj, EventLocation) and \
-            obj.location and \
+    if isinstance(obj, (Event, Occurrence)) and obj.location and \
             obj.location.mappable_location:
-        location = quote(obj.mappable_location)
-        marker = quote('{:.6},{:.6}'.format(obj.lat, obj.lon))
+        location = obj.location
+    elif isinstance(obj, EventLocation) and obj.mappable_location:
+        location = obj
     else:
         return ''
     if settings.EVENT_HIDPI_STATIC_MAPS:
         scale = 2
     else:
         scale = 1
-    key = settings.GOOGLE_API_KEY
-    url = "https://maps.googleapis.com/maps/api/staticmap?size={width}x{height}&scale={scale}&format=png&markers={marker}&sensor=false&zoom={zoom}&key={key}".format(**locals()).encode('utf-8')  # noqa: E501
-    url = sign_url(input_url=url, secret=settings.GOOGLE_STATIC_MAPS_API_SECRET)
-    if hasattr(settings, "GOOGLE_API_KEY"):
-        key = settings.GOOGLE_API_KEY
-        url += "&key={key}"
-    url = url.format(**locals()).encode('utf-8')
-    if hasattr(settings, "GOOGLE_STATIC_MAPS_API_SECRET"):
-        url = sign_url(input_url=url, secret=settings.GOOGLE_STATIC_MAPS_API_SECRET)
-
+    url = static_map_url(location, width, height, zoom, scale)
     return mark_safe(
         "<img src='{url}' width='{width}' height='{height}' />".format(**locals())
     )
@@ -286,12 +301,9 @@ def perdelta(start, end, delta):
 
 @register.as_tag
 def all_days(*args):
-    events = Event.objects.all().order_by('start')
-    if events:
-        lower = events[0].start
-        higher = events.latest('start').start
-        date_list = [d for d in perdelta(lower, higher, timedelta(days=1))]
-        return date_list
+    dates = Event.objects.aggregate(lower=Min('start'), higher=Max('start'))
+    if dates['lower'] is not None:
+        return list(perdelta(dates['lower'], dates['higher'], timedelta(days=1)))
     return []
 
 
@@ -300,19 +312,64 @@ def events_in_day(date):
     return Event.objects.filter(start__date=date)
 
 
+@register.as_tag
+@cache_tag("events_by_day")
+def events_by_day(first_day, last_day):
+    """
+    Put a ``{date: [events]}`` mapping of the published events between
+    two dates into the template context, fetched in one query. Usage::
+
+        {% events_by_day first_day last_day as days %}
+
+    """
+    return group_events_by_day(Event.objects.published(), first_day, last_day)
+
+
+@register.as_tag
+@cache_tag("calendar_month")
+def calendar_month(year, month):
+    """
+    Put the weeks of a month calendar into the template context, as
+    lists of ``(date, events)`` pairs of the published events, fetched
+    in one query. Usage::
+
+        {% calendar_month year month as weeks %}
+
+    """
+    return calendar_month_weeks(Event.objects.published(), int(year), int(month))
+
+
 @register.as_tag
 def all_weeks(*args):
-    events = Event.objects.all()
-    first_event = events[0]
-    last_event = events[len(events)-1]
+    dates = Event.objects.aggregate(first=Min('start'), last=Max('start'))
+    if dates['first'] is None:
+        return []
     return range(
-        first_event.start.isocalendar()[1], last_event.start.isocalendar()[1]+1
+        localize(dates['first']).isocalendar()[1],
+        localize(dates['last']).isocalendar()[1]+1
     )
 
 
+@register.as_tag
+@cache_tag("event_weeks")
+def event_weeks(*args):
+    """
+    Put the ISO weeks in which published events start into the template
+    context, as ``{year, week, event_count}`` dicts.
+    """
+    return count_events_by_week(Event.objects.published())
+
+
 @register.filter
 def week_range(week, year):
-    return week_day_range(year, week)
+    """
+    Return the monday and sunday of an ISO week, or ``None`` if the
+    year has no such week.
+    """
+    try:
+        return week_day_range(year, week)
+    except ValueError:
+        return None
 
 
 @register.filter
@@ -357,4 +414,7 @@ def tag_is_excluded(tag_id):
 
 @register.filter
 def get_tag(tag_id):
+    excluded_keywords = get_excluded_keywords()
+    if tag_id in excluded_keywords:
+        return excluded_keywords[tag_id]
     return Keyword.objects.get(id=tag_id)
@@ -5,19 +5,70 @@ try:
 except ImportError:
     from urlparse import urlparse
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
 
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from django.utils.timezone import make_aware
+from icalendar import Calendar
 from unittest import skipUnless, skip
+from unittest.mock import patch
 
-from mezzanine_agenda.models import Event, EventLocation
+import pytz
+
+from mezzanine_agenda.cache import bump_version, cache_key, get_excluded_keywords,\
+    next_transition, transition_timeout
+from mezzanine_agenda.forms import EventFilterForm, get_event_facets
+from mezzanine_agenda.ical import fragment_key, make_calendar, stream_calendar
+from mezzanine_agenda.maps import static_map_url
+from mezzanine_agenda.recurrence import event_occurrences, expand_occurrences,\
+    next_boundary
+from mezzanine_agenda.templatetags.event_tags import event_locations, event_months,\
+    google_calendar_url, upcoming_events, week_range
+from mezzanine_agenda.models import Event, EventCategory, EventLocation, EventPrice,\
+    GeocodeCache, GeocodeJob, prime_absolute_urls
+from mezzanine_agenda.views import EventListView
+from mezzanine_agenda.utils import calendar_month_weeks, count_events_by_day,\
+    count_events_by_week, group_events_by_day, group_events_by_month,\
+    event_timezone, iso_week_bounds, localize, site_domain
 from mezzanine.conf import settings
 
+from mezzanine.generic.models import Keyword
 from mezzanine.core.models import CONTENT_STATUS_DRAFT, CONTENT_STATUS_PUBLISHED
 from mezzanine.pages.models import RichTextPage
 from mezzanine.utils.tests import TestCase
 
 
+def fake_static_map(url):
+    fake_static_map.urls.append(url)
+    return b"PNG"
+
+
+fake_static_map.urls = []
+
+
+class FakeGeocoder(object):
+
+    queries = []
+
+    def geocode(self, query):
+        self.queries.append(query)
+        if "nowhere" in query:
+            return None
+        return query.title(), Decimal("48.8592"), Decimal("2.3516")
+
+
+@override_settings(EVENT_GEOCODER="mezzanine_agenda.tests.FakeGeocoder")
 class EventTests(TestCase):
 
     def setUp(self):
@@ -107,6 +158,113 @@ class EventTests(TestCase):
         self.event_page.login_required = False
         self.event_page.save()
 
+    def test_booking_state(self):
+        """
+        Test the annotated booking state matches the properties and
+        spares the queries of ``reserve_button``.
+        """
+        free = EventPrice.objects.create(value=0.0)
+        self.event.prices.add(free)
+        for event in Event.objects.with_booking_state():
+            self.assertEqual(event.is_free, event.prices.filter(value=0.0).exists())
+            self.assertEqual(event.has_vel, False)
+            self.assertIsNone(event.vel_url)
+        event = Event.objects.with_booking_state().get(id=self.event.id)
+        with self.assertNumQueries(0):
+            button = event.reserve_button
+        self.assertEqual(button['url'], self.event.get_absolute_url())
+
+    def test_event_facets(self):
+        """
+        Test facets only list locations having events, with their
+        number of events.
+        """
+        EventLocation.objects.create(address='No events here')
+        # no category to look up: grouped counts and locations only
+        with self.assertNumQueries(2):
+            facets = get_event_facets(Event.objects.published())
+        self.assertEqual(facets["categories"], [])
+        self.assertEqual(dict(facets["locations"]), {
+            self.eventlocation: 1,
+            self.unicode_eventlocation: 1,
+        })
+        form = EventFilterForm(facets=facets)
+        self.assertEqual(
+            sorted(value for value, label in
+                   form.fields['event_locations_filter'].choices),
+            sorted([str(self.eventlocation.pk), str(self.unicode_eventlocation.pk)])
+        )
+        category = EventCategory.objects.create(name="Concert")
+        Event.objects.filter(id=self.event.id).update(category=category)
+        facets = get_event_facets(
+            Event.objects.published(),
+            category_ids=[str(category.pk)],
+            location_ids=[str(self.unicode_eventlocation.pk)],
+        )
+        # options without results are hidden unless selected
+        self.assertEqual(dict(facets["categories"]), {category: 0})
+        self.assertEqual(dict(facets["locations"]), {
+            self.eventlocation: 1,
+            self.unicode_eventlocation: 0,
+        })
+        facets = get_event_facets(
+            Event.objects.published(), category_ids=[str(category.pk)]
+        )
+        self.assertEqual(dict(facets["locations"]), {self.eventlocation: 1})
+        # filters by title, submitted by the former form, are still applied
+        view = EventListView()
+        view.request = RequestFactory().get(
+            reverse("event_list"), {"event_categories_filter": ["Concert", "0"]}
+        )
+        self.assertEqual(
+            view.get_filter_ids("event_categories_filter", EventCategory, "name"),
+            ["0", str(category.pk)]
+        )
+
+    def test_cache_version(self):
+        """
+        Test agenda changes invalidate versioned cache keys.
+        """
+        key = cache_key("test")
+        self.assertEqual(cache_key("test"), key)
+        self.event.save()
+        self.assertNotEqual(cache_key("test"), key)
+        key = cache_key("test")
+        self.event.prices.add(EventPrice.objects.create(value=10.0))
+        self.assertNotEqual(cache_key("test"), key)
+        for name in ("links", "images", "periods"):
+            key = cache_key("test")
+            post_save.send(
+                sender=Event._meta.get_field(name).related_model,
+                instance=None, created=True,
+            )
+            self.assertNotEqual(cache_key("test"), key)
+
+    def test_next_transition(self):
+        """
+        Test time dependent caches expire when the next event ends.
+        """
+        self.assertEqual(next_transition(), Event.objects.get(id=self.event.id).end)
+        self.assertLessEqual(transition_timeout(), 4 * 60 * 60)
+        # one query per date column, the recurring events' boundaries
+        # being cached until one passes
+        cache.delete(cache_key("next_transition"))
+        with self.assertNumQueries(4):
+            next_transition()
+
+    def test_excluded_keywords(self):
+        """
+        Test excluded keywords are cached until a keyword changes.
+        """
+        keyword = Keyword.objects.create(title="hidden")
+        with override_settings(EVENT_EXCLUDE_TAG_LIST=[keyword.id]):
+            self.assertEqual(get_excluded_keywords(), {keyword.id: keyword})
+            with self.assertNumQueries(0):
+                get_excluded_keywords()
+            keyword.title = "renamed"
+            keyword.save()
+            self.assertEqual(get_excluded_keywords()[keyword.id].title, "renamed")
+
     @skip('too random')
     def test_clean(self):
         """
@@ -134,3 +292,606 @@ class EventTests(TestCase):
         response = self.client.get(reverse("icalendar"))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], 'text/calendar')
+
+    def test_icalendar_stream(self):
+        """
+        Test the streamed calendar is a valid iCalendar file holding
+        every upcoming published event.
+        """
+        response = self.client.get(reverse("icalendar"))
+        calendar = Calendar.from_ical(b"".join(response.streaming_content))
+        uids = [str(component["uid"]) for component in calendar.walk("vevent")]
+        self.assertEqual(len(uids), len(self.events))
+        for event in self.events:
+            self.assertIn("event-%s@" % event.id, " ".join(uids))
+
+    def test_conditional_get(self):
+        """
+        Test calendars answer 304 until one of their events changes or
+        the next transition passes.
+        """
+        for url in (reverse("icalendar"),
+                    reverse("icalendar_event", args=(self.event.slug,))):
+            response = self.client.get(url)
+            self.assertFalse(response.has_header("Last-Modified"))
+            etag = response["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.event.save()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etag)
+            etag = response["ETag"]
+            transition = make_aware(datetime.now() + timedelta(days=1))
+            with patch("mezzanine_agenda.views.next_transition",
+                       return_value=transition):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
+    def test_icalendar_fragment_cache(self):
+        """
+        Test unchanged events are served from the VEVENT cache, and
+        events are serialized again when they or agenda data change.
+        """
+        self.client.get(reverse("icalendar"))
+        domain = Site.objects.get_current().domain
+        key = fragment_key(self.event.id, self.event.updated, domain)
+        self.assertIsNotNone(cache.get(key))
+        cache.set(key, b"BEGIN:VEVENT\r\nUID:cached\r\nEND:VEVENT\r\n")
+        response = self.client.get(reverse("icalendar"))
+        self.assertIn(b"UID:cached", b"".join(response.streaming_content))
+        self.event.save()
+        response = self.client.get(reverse("icalendar"))
+        self.assertNotIn(b"UID:cached", b"".join(response.streaming_content))
+        # changes of related rows, such as the location, are seen too
+        key = fragment_key(self.event.id, self.event.updated, domain)
+        self.assertIsNotNone(cache.get(key))
+        cache.set(key, b"BEGIN:VEVENT\r\nUID:cached\r\nEND:VEVENT\r\n")
+        self.eventlocation.save()
+        response = self.client.get(reverse("icalendar"))
+        self.assertNotIn(b"UID:cached", b"".join(response.streaming_content))
+
+
+@override_settings(EVENT_GEOCODER="mezzanine_agenda.tests.FakeGeocoder")
+class EventGroupingTests(TestCase):
+
+    def _create_event(self, start, end=None):
+        return Event.objects.create(
+            title='Event %s' % start.isoformat(),
+            start=start,
+            end=end,
+            status=CONTENT_STATUS_PUBLISHED,
+            user=self._user,
+        )
+
+    def _create_monthly_events(self, first, count):
+        for i in range(first, first + count):
+            self._create_event(datetime(2030 + i // 12, i % 12 + 1, 15, 20))
+
+    def _group(self, reverse=False):
+        order = "-start" if reverse else "start"
+        events = Event.objects.published().order_by(order)
+        with CaptureQueriesContext(connection) as context:
+            events_by_month = group_events_by_month(events, reverse=reverse)
+        return events_by_month, len(context.captured_queries)
+
+    def test_query_count_is_constant(self):
+        """
+        Benchmark the grouping engine: the number of queries doesn't
+        grow with the number of months.
+        """
+        self._create_monthly_events(0, 3)
+        events_by_month, few_months_queries = self._group()
+        self.assertEqual(len(events_by_month), 3)
+        self._create_monthly_events(3, 27)
+        events_by_month, many_months_queries = self._group()
+        self.assertEqual(len(events_by_month), 30)
+        self.assertEqual(few_months_queries, many_months_queries)
+
+    def test_overlap(self):
+        """
+        Going backwards, an event lands in the latest month it covers.
+        """
+        long_event = self._create_event(
+            datetime(2030, 9, 15), datetime(2030, 12, 20)
+        )
+        november_event = self._create_event(datetime(2030, 11, 3))
+        events_by_month, queries = self._group()
+        self.assertEqual(
+            list(events_by_month.values()), [[long_event], [november_event]]
+        )
+        events_by_month, queries = self._group(reverse=True)
+        self.assertEqual(
+            list(events_by_month.values()), [[november_event, long_event], []]
+        )
+
+    def test_event_months(self):
+        """
+        Months are counted in a grouped query, plus one listing the
+        recurring events, and cached until agenda data changes.
+        """
+        cache.clear()
+        self._create_monthly_events(0, 3)
+        self._create_event(datetime(2030, 2, 1, 12))
+        with self.assertNumQueries(2):
+            months = event_months()
+        self.assertEqual(
+            [(month["date"], month["event_count"]) for month in months],
+            [(datetime(2030, 1, 1), 1), (datetime(2030, 2, 1), 2),
+             (datetime(2030, 3, 1), 1)],
+        )
+        with override_settings(EVENT_TAG_CACHE=False):
+            with self.assertNumQueries(0):
+                event_months()
+
+    def test_calendar_month(self):
+        """
+        The grid of a month is built in one query, multi-day events
+        being listed on every day they cover.
+        """
+        festival = self._create_event(
+            datetime(2030, 4, 29, 18), datetime(2030, 5, 2, 0)
+        )
+        concert = self._create_event(datetime(2030, 5, 15, 20))
+        self._create_event(datetime(2030, 7, 1, 20))
+        with self.assertNumQueries(1):
+            weeks = calendar_month_weeks(Event.objects.published(), 2030, 5)
+        days = dict(day for week in weeks for day in week)
+        self.assertEqual(weeks[0][0][0], date(2030, 4, 29))
+        self.assertEqual(days[date(2030, 4, 29)], [festival])
+        self.assertEqual(days[date(2030, 5, 1)], [festival])
+        self.assertEqual(days[date(2030, 5, 2)], [])
+        self.assertEqual(days[date(2030, 5, 15)], [concert])
+        self.assertEqual(sum(len(events) for events in days.values()), 4)
+
+    def test_iso_weeks(self):
+        """
+        Week bounds follow DST changes and weeks are counted in a
+        grouped query.
+        """
+        paris = pytz.timezone("Europe/Paris")
+        lower, upper = iso_week_bounds(2030, 13, paris)
+        self.assertEqual(lower, paris.localize(datetime(2030, 3, 25)))
+        self.assertEqual(upper, paris.localize(datetime(2030, 4, 1)))
+        self.assertEqual(upper - lower, timedelta(days=7, hours=-1))
+        self.assertRaises(ValueError, iso_week_bounds, 2030, 53)
+        self.assertIsNone(week_range(53, 2030))
+        self.assertEqual(week_range(1, 2030), (date(2029, 12, 31), date(2030, 1, 6)))
+        self._create_event(datetime(2030, 3, 31, 20))
+        self._create_event(datetime(2030, 4, 1, 20))
+        self._create_event(datetime(2030, 4, 7, 20))
+        # grouped one-off events, and recurring ones
+        with self.assertNumQueries(2):
+            weeks = count_events_by_week(Event.objects.published())
+        self.assertEqual(
+            [(week["year"], week["week"], week["event_count"]) for week in weeks],
+            [(2030, 13, 1), (2030, 14, 2)],
+        )
+        lower, upper = iso_week_bounds(2030, 14)
+        week_events = Event.objects.filter(start__gte=lower, start__lt=upper)
+        self.assertEqual(week_events.count(), 2)
+
+    def test_day_counts(self):
+        """
+        Days are counted in one grouped query, spreading multi-day
+        events, and drafts are only counted for staff users.
+        """
+        self._create_event(datetime(2030, 4, 29, 18), datetime(2030, 5, 2, 0))
+        self._create_event(datetime(2030, 5, 1, 20))
+        self._create_event(datetime(2030, 5, 31, 20), datetime(2030, 6, 1, 2))
+        draft = self._create_event(datetime(2030, 5, 10, 20))
+        draft.status = CONTENT_STATUS_DRAFT
+        draft.save()
+        with self.assertNumQueries(1):
+            days = count_events_by_day(
+                Event.objects.published(), date(2030, 5, 1), date(2030, 5, 31)
+            )
+        self.assertEqual(len(days), 31)
+        self.assertEqual(days[date(2030, 5, 1)], 2)
+        self.assertEqual(days[date(2030, 5, 2)], 0)
+        self.assertEqual(days[date(2030, 5, 10)], 0)
+        self.assertEqual(days[date(2030, 5, 31)], 1)
+        url = reverse("event_day_counts_month", args=(2030, 5))
+        self.assertEqual(self.client.get(url).json()["days"]["2030-05-10"], 0)
+        self.client.login(username=self._username, password=self._password)
+        self.assertEqual(self.client.get(url).json()["days"]["2030-05-10"], 1)
+        response = self.client.get(
+            reverse("event_day_counts"), {"start": "2030-05-31", "end": "2030-06-01"}
+        )
+        self.assertEqual(
+            response.json()["days"], {"2030-05-31": 1, "2030-06-01": 1}
+        )
+        response = self.client.get(reverse("event_day_counts"), {"start": "2030"})
+        self.assertEqual(response.status_code, 404)
+        url = reverse("event_day_counts").replace("days.json", "daysXjson")
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_tag_cache(self):
+        """
+        Template tags accept ids and cost no query once cached.
+        """
+        location = EventLocation.objects.create(title="Hall", address="Paris")
+        event = self._create_event(datetime(2030, 4, 1, 20))
+        event.location = location
+        event.save()
+        self._create_event(datetime(2030, 4, 2, 20))
+        self.assertEqual(upcoming_events(location=location.id), [event])
+        self.assertEqual(upcoming_events(location="Hall"), [event])
+        self.assertEqual(upcoming_events(location="Nowhere"), [])
+        self.assertEqual(len(upcoming_events(username=self._user.id)), 2)
+        event_locations()
+        with self.assertNumQueries(0):
+            self.assertEqual(upcoming_events(location=location.id), [event])
+            self.assertEqual(len(event_locations()), 1)
+        with override_settings(EVENT_TAG_CACHE=False):
+            with self.assertNumQueries(1):
+                upcoming_events(location=location.id)
+
+    def test_tag_filter(self):
+        """
+        Events matching the tag through several keywords are listed once.
+        """
+        first = self._create_event(datetime(2030, 4, 1, 20))
+        second = self._create_event(datetime(2030, 4, 2, 20))
+        for title, slug in (("concert", "concerts"), ("live", "concert")):
+            first.keywords.create(
+                keyword=Keyword.objects.create(title=title, slug=slug)
+            )
+        second.keywords.create(keyword=Keyword.objects.get(title="concert"))
+        self.assertEqual(upcoming_events(limit=2, tag="concert"), [first, second])
+
+    def test_site_domain(self):
+        """
+        The site domain is fetched once, until the site is saved.
+        """
+        site = Site.objects.get(id=settings.SITE_ID)
+        site_domain()
+        with self.assertNumQueries(0):
+            self.assertEqual(site_domain(), site.domain)
+        site.domain = "agenda.example.com"
+        site.save()
+        self.assertEqual(site_domain(), "agenda.example.com")
+        # another process only sees the new cache version
+        Site.objects.filter(id=site.id).update(domain="www.example.com")
+        self.assertEqual(site_domain(), "agenda.example.com")
+        bump_version()
+        self.assertEqual(site_domain(), "www.example.com")
+
+    @override_settings(
+        GOOGLE_API_KEY="key",
+        EVENT_STATIC_MAPS_STORAGE=True,
+        EVENT_STATIC_MAPS_FETCHER="mezzanine_agenda.tests.fake_static_map",
+    )
+    def test_static_map(self):
+        """
+        Static maps are fetched once into the media storage.
+        """
+        cache.clear()
+        location = EventLocation.objects.create(
+            title="Map", address="Paris", mappable_location="Paris",
+            lat=Decimal("48.8592"), lon=Decimal("2.3516"),
+        )
+        del fake_static_map.urls[:]
+        url = static_map_url(location, 300, 200, 15)
+        self.assertEqual(len(fake_static_map.urls), 1)
+        self.assertIn("markers=48.8592%2C2.3516", fake_static_map.urls[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(static_map_url(location, 300, 200, 15), url)
+        self.assertEqual(len(fake_static_map.urls), 1)
+        with override_settings(GOOGLE_STATIC_MAPS_API_SECRET="c2VjcmV0"):
+            signed_url = static_map_url(location, 300, 200, 15)
+        self.assertNotEqual(signed_url, url)
+        self.assertIn("signature=", fake_static_map.urls[1])
+        for map_url in (url, signed_url):
+            name = "agenda/maps/%s" % map_url.rsplit("/", 1)[1]
+            self.assertTrue(default_storage.exists(name))
+            default_storage.delete(name)
+
+    def test_geocode_cache(self):
+        """
+        Each normalized address is geocoded once.
+        """
+        del FakeGeocoder.queries[:]
+        first = EventLocation.objects.create(
+            title="First", address="1 place Igor Stravinsky",
+            mappable_location="1 place Igor Stravinsky,75004  Paris",
+        )
+        second = EventLocation.objects.create(
+            title="Second", address="1 place Igor Stravinsky",
+            mappable_location="1 Place Igor Stravinsky, 75004 Paris ",
+        )
+        self.assertEqual(
+            FakeGeocoder.queries, ["1 place igor stravinsky, 75004 paris"]
+        )
+        self.assertEqual((first.lat, first.lon), (second.lat, second.lon))
+        self.assertEqual(GeocodeCache.objects.count(), 1)
+        location = EventLocation(
+            title="Nowhere", address="Nowhere", mappable_location="Nowhere"
+        )
+        self.assertRaises(ValidationError, location.clean)
+        with override_settings(EVENT_GEOCODER="mezzanine_agenda.geocoding.DummyGeocoder"):
+            offline = EventLocation.objects.create(
+                title="Offline", address="Offline", mappable_location="Offline"
+            )
+        self.assertIsNone(offline.lat)
+        self.assertEqual(GeocodeCache.objects.count(), 1)
+        offline.save()
+        self.assertIsNotNone(offline.lat)
+        self.assertEqual(FakeGeocoder.queries[-1], "offline")
+
+    @override_settings(EVENT_GEOCODE_ASYNC=True)
+    def test_geocode_jobs(self):
+        """
+        Locations saved in async mode are geocoded by the command.
+        """
+        del FakeGeocoder.queries[:]
+        for i in range(3):
+            EventLocation.objects.create(
+                title="Venue %s" % i, address="%s rue Saint-Merri" % i,
+                postal_code="75004", city="Paris",
+            )
+        EventLocation.objects.create(title="Nowhere", address="nowhere")
+        self.assertEqual(FakeGeocoder.queries, [])
+        self.assertEqual(GeocodeJob.objects.count(), 4)
+        call_command(
+            "agenda_geocode", workers=2, rate=0, backoff=0, stdout=StringIO()
+        )
+        self.assertEqual(len(FakeGeocoder.queries), 4)
+        self.assertFalse(EventLocation.objects.filter(
+            title__startswith="Venue", lat__isnull=True
+        ).exists())
+        self.assertEqual(
+            GeocodeJob.objects.get(location__title="Nowhere").status,
+            GeocodeJob.FAILED
+        )
+        call_command("agenda_geocode_backfill", drain=True, stdout=StringIO())
+        self.assertEqual(len(FakeGeocoder.queries), 5)
+
+    def test_parent_inheritance(self):
+        """
+        Children take some values from their parent in a single save.
+        """
+        location = EventLocation.objects.create(
+            title="Hall", address="Paris", lat=Decimal("48.8592"),
+            lon=Decimal("2.3516"),
+        )
+        parent = self._create_event(datetime(2030, 6, 1, 20))
+        parent.location = location
+        parent.mentions = "Festival"
+        parent.status = CONTENT_STATUS_DRAFT
+        parent.save()
+        child = Event(
+            title="Child", start=datetime(2030, 6, 2, 20), parent=parent,
+            mentions="Concert", user=self._user,
+        )
+        child.save()
+        child = Event.objects.get(id=child.id)
+        self.assertEqual(child.title, parent.title)
+        self.assertEqual(child.status, CONTENT_STATUS_DRAFT)
+        self.assertEqual(child.location, location)
+        self.assertEqual(child.mentions, "Concert")
+
+    def test_propagate_to_children(self):
+        """
+        Saving a parent pushes its changes to its children in bulk.
+        """
+        parent = self._create_event(datetime(2030, 6, 1, 20))
+        parent.mentions = "Festival"
+        parent.save()
+        children = [
+            Event.objects.create(
+                title="Child", start=datetime(2030, 6, 2 + i, 20),
+                parent=parent, user=self._user,
+            )
+            for i in range(3)
+        ]
+        children[0].mentions = "Concert"
+        children[0].save()
+        parent.title = "Festival 2030"
+        parent.mentions = "Festival of 2030"
+        parent.status = CONTENT_STATUS_DRAFT
+        parent.save()
+        children = Event.objects.filter(parent=parent).order_by("start")
+        self.assertEqual(
+            [(child.title, child.mentions, child.status) for child in children],
+            [("Festival 2030", "Concert", CONTENT_STATUS_DRAFT)] +
+            [("Festival 2030", "Festival of 2030", CONTENT_STATUS_DRAFT)] * 2
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(parent.propagate_to_children(), 0)
+
+    def test_start_date_neighbours(self):
+        """
+        Both neighbours of an event are found with a single query once
+        the index is cached, skipping children.
+        """
+        first, second, third = [
+            self._create_event(datetime(2030, 6, day, 20)) for day in (1, 2, 3)
+        ]
+        Event.objects.create(
+            title="Child", start=datetime(2030, 6, 2, 21), parent=first,
+            user=self._user,
+        )
+        Event.objects.get(id=first.id).get_next_by_start_date()
+        event = Event.objects.get(id=second.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(event.get_previous_by_start_date(), first)
+            self.assertEqual(event.get_next_by_start_date(), third)
+        event = Event.objects.get(id=third.id)
+        self.assertIsNone(event.get_next_by_start_date())
+        third.status = CONTENT_STATUS_DRAFT
+        third.save()
+        event = Event.objects.get(id=second.id)
+        self.assertIsNone(event.get_next_by_start_date())
+        self.assertEqual(event.get_next_by_start_date(for_user=self._user), third)
+
+    def test_absolute_urls(self):
+        """
+        URLs primed in bulk match the reversed ones, with a single
+        reverse per publish date prefix.
+        """
+        for day in (1, 2, 3):
+            self._create_event(datetime(2030, 6, day, 20))
+        Event.objects.filter(start__day=1).update(slug="caf\xe9 & co")
+        for date_format in ("", "month"):
+            with override_settings(EVENT_URLS_DATE_FORMAT=date_format):
+                events = list(Event.objects.order_by("start"))
+                expected = [
+                    reverse(url_name, kwargs=kwargs) for url_name, kwargs in
+                    (event.get_url_name_kwargs() for event in events)
+                ]
+                with patch("mezzanine_agenda.models.reverse", wraps=reverse) as mocked:
+                    prime_absolute_urls(events)
+                    urls = [event.get_absolute_url() for event in events]
+                self.assertEqual(urls, expected)
+                self.assertEqual(mocked.call_count, 1)
+
+    def test_icalendar_series(self):
+        """
+        Children are encoded as dates of their parent's VEVENT, with
+        overrides only for the children differing from it.
+        """
+        parent = self._create_event(
+            datetime(2030, 6, 1, 20), datetime(2030, 6, 1, 22)
+        )
+        for i in range(1, 4):
+            Event.objects.create(
+                title="Child", start=datetime(2030, 6, 1 + 7 * i, 20),
+                end=datetime(2030, 6, 1 + 7 * i, 22 + i // 3), parent=parent,
+                user=self._user,
+            )
+        events = Event.objects.filter(
+            id__in=[parent.id] + list(parent.children.values_list("id", flat=True))
+        ).order_by("start")
+        per_child = Calendar.from_ical(
+            b"".join(stream_calendar(events, "example.com", series=False))
+        )
+        self.assertEqual(len(per_child.walk("vevent")), 4)
+        series = Calendar.from_ical(
+            b"".join(stream_calendar(events, "example.com", series=True))
+        )
+        master, override = series.walk("vevent")
+        self.assertEqual(master["rrule"]["freq"], ["WEEKLY"])
+        self.assertEqual(master["rrule"]["count"], [4])
+        self.assertEqual(override["uid"], master["uid"])
+        self.assertEqual(
+            localize(override["recurrence-id"].dt),
+            localize(make_aware(datetime(2030, 6, 22, 20)))
+        )
+        child = parent.children.order_by("start").first()
+        child.start = child.start + timedelta(days=1)
+        child.end = child.end + timedelta(days=1)
+        child.save()
+        series = Calendar.from_ical(
+            b"".join(stream_calendar(events, "example.com", series=True))
+        )
+        self.assertNotIn("rrule", series.walk("vevent")[0])
+        self.assertIn("rdate", series.walk("vevent")[0])
+
+    def test_recurrence(self):
+        """
+        Occurrences of recurring events are expanded for a window,
+        grouped by month and materialized on demand.
+        """
+        show = self._create_event(
+            datetime(2030, 1, 25, 20), datetime(2030, 1, 25, 22)
+        )
+        show.recurrence = "RRULE:FREQ=WEEKLY;COUNT=4\nEXDATE:20300201T200000"
+        show.save()
+        self.assertEqual(
+            localize(show.recurrence_end),
+            localize(make_aware(datetime(2030, 2, 15, 22)))
+        )
+        self.assertTrue(Event.objects.upcoming(
+            make_aware(datetime(2030, 2, 10))
+        ).filter(id=show.id).exists())
+        events = expand_occurrences(
+            Event.objects.filter(id=show.id), make_aware(datetime(2030, 1, 1))
+        )
+        self.assertEqual(
+            [localize(event.start).day for event in events], [25, 8, 15]
+        )
+        self.assertIs(events[1].event, show)
+        self.assertEqual(events[1].title, show.title)
+        events_by_month = group_events_by_month(events)
+        self.assertEqual(
+            [len(month) for month in events_by_month.values()], [1, 2]
+        )
+        shows = Event.objects.filter(id=show.id)
+        days = count_events_by_day(shows, date(2030, 2, 1), date(2030, 2, 28))
+        self.assertEqual([day.day for day, count in days.items() if count], [8, 15])
+        days = group_events_by_day(shows, date(2030, 2, 1), date(2030, 2, 28))
+        self.assertEqual([day.day for day, events in days.items() if events], [8, 15])
+        self.assertEqual(
+            [(week["week"], week["event_count"]) for week in count_events_by_week(shows)],
+            [(4, 1), (6, 1), (7, 1)]
+        )
+        cache.clear()
+        self.assertEqual(
+            [(month["date"], month["event_count"]) for month in event_months()],
+            [(datetime(2030, 1, 1), 1), (datetime(2030, 2, 1), 2)]
+        )
+        for now, boundary in ((datetime(2030, 2, 2), datetime(2030, 2, 8, 20)),
+                              (datetime(2030, 2, 8, 21), datetime(2030, 2, 8, 22))):
+            self.assertEqual(
+                localize(next_boundary(show, make_aware(now))),
+                localize(make_aware(boundary))
+            )
+        vevent = show.get_icalendar_event()
+        self.assertEqual(vevent["rrule"]["count"], [4])
+        self.assertIn("exdate", vevent)
+        self.assertEqual(
+            [str(tz["tzid"]) for tz in make_calendar().walk("vtimezone")],
+            [str(event_timezone())]
+        )
+        weekly = Event.objects.create(
+            title="Weekly", start=make_aware(datetime(2030, 1, 7, 20)),
+            recurrence="RRULE:FREQ=WEEKLY;UNTIL=20300301T200000", user=self._user,
+        )
+        until = weekly.get_icalendar_event()["rrule"]["until"][0]
+        self.assertEqual(until, make_aware(datetime(2030, 3, 1, 20), event_timezone()))
+        self.assertEqual(until.utcoffset(), timedelta(0))
+        folded = Event.objects.create(
+            title="Folded", start=make_aware(datetime(2030, 1, 7, 20)),
+            recurrence="RRULE:FREQ=WEEKLY;\n COUNT=3\n"
+                       "RDATE:20300201T200000, 20300301T200000",
+            user=self._user,
+        )
+        self.assertIsNotNone(folded.recurrence_end)
+        vevent = folded.get_icalendar_event()
+        self.assertEqual(vevent["rrule"]["count"], [3])
+        self.assertEqual(len(vevent["rdate"].dts), 2)
+        weekly.recurrence = "RRULE:FREQ=SECONDLY;UNTIL=20400101T000000"
+        self.assertRaises(ValidationError, weekly.clean)
+        weekly.save()
+        self.assertIsNone(weekly.recurrence_end)
+        call_command(
+            "agenda_materialize_occurrences", until="2030-12-31", stdout=StringIO()
+        )
+        self.assertEqual(show.children.count(), 2)
+        show.refresh_from_db()
+        self.assertEqual(
+            event_occurrences(show, show.start, show.start + timedelta(days=60)),
+            []
+        )
+
+    def test_occurrence_state(self):
+        """
+        Occurrences are archived and booked on their own dates.
+        """
+        start = make_aware(datetime.now() - timedelta(days=10))
+        show = self._create_event(start, start + timedelta(hours=2))
+        show.recurrence = "RRULE:FREQ=WEEKLY;COUNT=3"
+        show.save()
+        show.prices.add(EventPrice.objects.create(value=0.0))
+        past, future = event_occurrences(show, start, start + timedelta(days=30))
+        self.assertTrue(show.is_archived)
+        self.assertTrue(past.is_archived)
+        self.assertFalse(future.is_archived)
+        self.assertEqual(show.reserve_button, {})
+        self.assertEqual(past.reserve_button, {})
+        self.assertEqual(future.reserve_button["url"], show.get_absolute_url())
+        self.assertIn(
+            future.start.astimezone(pytz.utc).strftime("%Y%m%dT%H%M%SZ"),
+            google_calendar_url(future)
+        )
@@ -7,7 +7,7 @@ from mezzanine_agenda.views import event_feed, EventListView, icalendar,\
     ArchiveListView, event_detail, icalendar_event, event_booking,\
     EventBookingShopConfirmationView, EventBookingGlobalConfirmationView,\
     EventBookingPassView, LocationListView, LocationDetailView,\
-    EventPriceAutocompleteView
+    EventPriceAutocompleteView, event_day_counts
 
 # Trailing slash for urlpatterns based on setup.
 _slash = "/" if settings.APPEND_SLASH else ""
@@ -62,6 +62,9 @@ urlpatterns = [
         icalendar_event, name="icalendar_event_year"),
     url("^(?P<slug>.*)/detail/event.ics$", icalendar_event, name="icalendar_event"),
     url("^calendar.ics$", icalendar, name="icalendar"),
+    url(r"^days\.json$", event_day_counts, name="event_day_counts"),
+    url(r"^days/(?P<year>\d{4})/(?P<month>\d{1,2})\.json$", event_day_counts,
+        name="event_day_counts_month"),
     url(
         "^(?P<slug>.*)/detail[%s]?$" % _slash, event_detail,
         name="event_detail"
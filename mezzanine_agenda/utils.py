@@ -3,8 +3,40 @@
 import hashlib
 import hmac
 import base64
+from calendar import Calendar, monthrange
+from datetime import datetime, time, timedelta
+from functools import lru_cache
 from urllib.parse import urlparse
 
+from django.contrib.sites.models import Site
+from django.db.models import Count, DateTimeField, ExpressionWrapper, F, Q
+from django.db.models.functions import ExtractIsoYear, ExtractWeek, TruncDate
+from django.utils import timezone, translation
+from django.utils.translation import ugettext_lazy as _
+from mezzanine.conf import settings
+from mezzanine.core.request import current_request
+from mezzanine.utils.sites import current_site_id
+
+import pytz
+
+# site domains by site id, see site_domain
+_site_domains = {}
+
+MONTH_CHOICES = {
+    1: _('January'),
+    2: _('February'),
+    3: _('March'),
+    4: _('April'),
+    5: _('May'),
+    6: _('June'),
+    7: _('July'),
+    8: _('August'),
+    9: _('September'),
+    10: _('October'),
+    11: _('November'),
+    12: _('December'),
+}
+
 
 def sign_url(input_url=None, secret=None):
     """ Sign a request URL with a URL signing secret.
@@ -51,3 +83,296 @@ def sign_url(input_url=None, secret=None):
 
     # Return signed URL
     return original_url + "&signature=" + str(encoded_signature, 'utf-8')
+
+
+def localize(value):
+    """
+    Convert an aware datetime to the current time zone, the same way
+    the database does for ``__year`` / ``__month`` lookups.
+    """
+    if value is not None and timezone.is_aware(value):
+        return timezone.localtime(value)
+    return value
+
+
+def month_label(year, month):
+    """
+    Key of a month in ``events_by_month``: the french month name, used
+    to build anchors, then the month name in the active language.
+    """
+    with translation.override('fr'):
+        anchor = str(MONTH_CHOICES[month])
+    return anchor + ' ' + str(year) + ',' + str(MONTH_CHOICES[month]) + ' ' + str(year)
+
+
+def _spans_month(end, year, month):
+    """
+    Whether an event ending at ``end`` covers the whole given month,
+    i.e. ends after the beginning of its last day.
+    """
+    last_day = datetime(year, month, monthrange(year, month)[1])
+    return end is not None and end.replace(tzinfo=None) > last_day
+
+
+def group_events_by_month(events, reverse=False):
+    """
+    Group events ordered by start date (descending if ``reverse``) into
+    an ordered ``{month_label: [events]}`` mapping, evaluating the
+    queryset once.
+
+    Buckets are the months in which events start. Each event goes to
+    the first bucket, in iteration order, it belongs to: its start
+    month, or when iterating backwards the latest month of the same
+    year it entirely covers. Events repeated by joins are kept once,
+    occurrences of recurring events being told apart by their start.
+    """
+    events = [(event, localize(event.start), localize(event.end))
+              for event in events]
+    buckets = {}
+    for event, start, end in events:
+        buckets.setdefault((start.year, start.month), [])
+    seen = set()
+    for event, start, end in events:
+        if (event.pk, event.start) in seen:
+            continue
+        seen.add((event.pk, event.start))
+        bucket = (start.year, start.month)
+        if reverse:
+            for month in range(12, start.month, -1):
+                if (start.year, month) in buckets and \
+                        _spans_month(end, start.year, month):
+                    bucket = (start.year, month)
+                    break
+        buckets[bucket].append(event)
+    return {
+        month_label(year, month): bucket_events
+        for (year, month), bucket_events in buckets.items()
+    }
+
+
+def day_bounds(first_day, last_day):
+    """
+    Return the datetimes at which ``first_day`` begins and the day after
+    ``last_day`` begins, aware in the current time zone when time zone
+    support is enabled.
+    """
+    lower = datetime.combine(first_day, time.min)
+    upper = datetime.combine(last_day + timedelta(days=1), time.min)
+    if settings.USE_TZ:
+        lower, upper = timezone.make_aware(lower), timezone.make_aware(upper)
+    return lower, upper
+
+
+def _overlapping(lower, upper):
+    """
+    Match the events overlapping ``lower`` to ``upper``, and the
+    recurring ones which may have occurrences in between.
+    """
+    # imported here as the recurrence module imports this one
+    from mezzanine_agenda.recurrence import recurring_between
+    return (
+        (Q(end__gt=lower) | Q(end__isnull=True, start__gte=lower)) &
+        Q(start__lt=upper)
+    ) | recurring_between(lower, upper)
+
+
+def _covered_days(start, end, first_day, last_day):
+    """
+    Return the days from ``first_day`` to ``last_day`` covered by an
+    event from ``start`` to ``end``.
+    """
+    start, end = localize(start), localize(end)
+    day = max(start.date(), first_day)
+    last = start.date()
+    if end is not None and end > start:
+        last = (end - timedelta(microseconds=1)).date()
+    days = []
+    while day <= min(last, last_day):
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def group_events_by_day(events, first_day, last_day):
+    """
+    Return an ordered ``{date: [events]}`` mapping with an entry for
+    each day from ``first_day`` to ``last_day``, fetching the events
+    overlapping that window in a single query. An event is listed on
+    every day it covers, an event ending at midnight not covering the
+    following day. Recurring events are listed at each of their
+    occurrences.
+    """
+    from mezzanine_agenda.recurrence import expand_occurrences
+    lower, upper = day_bounds(first_day, last_day)
+    events = events.filter(_overlapping(lower, upper)).order_by("start")
+    days = {}
+    day = first_day
+    while day <= last_day:
+        days[day] = []
+        day += timedelta(days=1)
+    for event in expand_occurrences(events, lower, upper):
+        for day in _covered_days(event.start, event.end, first_day, last_day):
+            days[day].append(event)
+    return days
+
+
+def count_events_by_day(events, first_day, last_day):
+    """
+    Return an ordered ``{date: event_count}`` mapping with an entry for
+    each day from ``first_day`` to ``last_day``, counting every day an
+    event covers like ``group_events_by_day``. Events are grouped by
+    their first and last days in a single query, then spread over the
+    days in between. Recurring events are fetched apart and counted at
+    each of their occurrences.
+    """
+    from mezzanine_agenda.recurrence import expand_occurrences
+    lower, upper = day_bounds(first_day, last_day)
+    events = events.filter(_overlapping(lower, upper))
+    spans = events.filter(recurrence="").annotate(
+        first_day=TruncDate("start"),
+        last_day=TruncDate(ExpressionWrapper(
+            F("end") - timedelta(microseconds=1),
+            output_field=DateTimeField()
+        )),
+    ).values("first_day", "last_day").annotate(
+        event_count=Count("id", distinct=True)
+    ).order_by()
+    days = {}
+    day = first_day
+    while day <= last_day:
+        days[day] = 0
+        day += timedelta(days=1)
+    for span in spans:
+        day = max(span["first_day"], first_day)
+        last = max(span["last_day"] or span["first_day"], span["first_day"])
+        while day <= min(last, last_day):
+            days[day] += span["event_count"]
+            day += timedelta(days=1)
+    recurring = events.exclude(recurrence="").distinct()
+    for event in expand_occurrences(recurring, lower, upper):
+        for day in _covered_days(event.start, event.end, first_day, last_day):
+            days[day] += 1
+    return days
+
+
+def calendar_month_weeks(events, year, month, firstweekday=0):
+    """
+    Return the weeks of a month calendar as lists of ``(date, events)``
+    pairs, including the days of adjacent months completing the first
+    and last weeks.
+    """
+    weeks = Calendar(firstweekday).monthdatescalendar(year, month)
+    days = group_events_by_day(events, weeks[0][0], weeks[-1][-1])
+    return [[(day, days[day]) for day in week] for week in weeks]
+
+
+def site_domain(site_id=None):
+    """
+    Return the domain of the given site, the current one by default.
+    Domains are memoized on the current request, and in the process
+    for the current agenda cache version, which changes in every
+    process sharing the cache when a site is saved or deleted.
+    """
+    # imported here as the cache module imports this one
+    from mezzanine_agenda.cache import get_version
+    if site_id is None:
+        site_id = current_site_id()
+    request = current_request()
+    if request is None:
+        domains = {}
+    elif not hasattr(request, "_agenda_site_domains"):
+        domains = request._agenda_site_domains = {}
+    else:
+        domains = request._agenda_site_domains
+    if site_id not in domains:
+        version = get_version()
+        if _site_domains.get(site_id, (None,))[0] != version:
+            _site_domains[site_id] = (version, Site.objects.get(id=site_id).domain)
+        domains[site_id] = _site_domains[site_id][1]
+    return domains[site_id]
+
+
+def clear_site_domains():
+    """
+    Forget the site domains memoized in the process.
+    """
+    _site_domains.clear()
+
+
+@lru_cache(maxsize=None)
+def _named_timezone(name):
+    return pytz.timezone(name)
+
+
+def event_timezone():
+    """
+    Return the time zone event times are written in: ``EVENT_TIME_ZONE``
+    or the default time zone.
+    """
+    if settings.EVENT_TIME_ZONE != "":
+        return _named_timezone(settings.EVENT_TIME_ZONE)
+    return timezone.get_default_timezone()
+
+
+def iso_week_monday(year, week):
+    """
+    Return the monday of the given ISO week, raising ``ValueError`` if
+    the year has no such week.
+    """
+    year, week = int(year), int(week)
+    monday = datetime.strptime("%d %d 1" % (year, week), "%G %V %u").date()
+    if monday.isocalendar()[:2] != (year, week):
+        raise ValueError("%d has no ISO week %d" % (year, week))
+    return monday
+
+
+def iso_week_bounds(year, week, tz=None):
+    """
+    Return the datetimes at which the given ISO week and the following
+    one begin. Each bound is localized separately in ``tz``, defaulting
+    to ``event_timezone()``, so a week containing a DST change is an
+    hour shorter or longer.
+    """
+    lower = datetime.combine(iso_week_monday(year, week), time.min)
+    upper = lower + timedelta(weeks=1)
+    if settings.USE_TZ:
+        tz = tz or event_timezone()
+        lower, upper = timezone.make_aware(lower, tz), timezone.make_aware(upper, tz)
+    return lower, upper
+
+
+def count_events_by_week(events, tz=None):
+    """
+    Return the ISO weeks in which events start, in ``tz`` defaulting
+    to ``event_timezone()``, as ordered ``{"year", "week",
+    "event_count"}`` dicts computed by a single grouped query.
+    Recurring events are fetched apart and counted at each of their
+    occurrences, up to ``EVENT_RECURRENCE_HORIZON`` days after now, or
+    after their first date when it's later, like ``event_months``.
+    """
+    from mezzanine_agenda.recurrence import event_occurrences
+    tz = tz or event_timezone()
+    weeks = events.filter(recurrence="").annotate(
+        iso_year=ExtractIsoYear("start", tzinfo=tz),
+        iso_week=ExtractWeek("start", tzinfo=tz),
+    ).values("iso_year", "iso_week").annotate(
+        event_count=Count("id", distinct=True)
+    ).order_by("iso_year", "iso_week")
+    counts = {}
+    for week in weeks:
+        counts[(week["iso_year"], week["iso_week"])] = week["event_count"]
+    now = timezone.now()
+    for event in events.exclude(recurrence="").distinct():
+        horizon = max(now, event.start) + timedelta(
+            days=settings.EVENT_RECURRENCE_HORIZON
+        )
+        for occurrence in [event] + event_occurrences(event, event.start, horizon):
+            start = occurrence.start
+            if timezone.is_aware(start):
+                start = timezone.make_naive(start, tz)
+            week = tuple(start.isocalendar()[:2])
+            counts[week] = counts.get(week, 0) + 1
+    return [
+        {"year": year, "week": week, "event_count": counts[(year, week)]}
+        for year, week in sorted(counts)
+    ]
@@ -3,62 +3,108 @@ from future.builtins import str
 from future.builtins import int
 from calendar import month_name, monthrange
 from datetime import datetime, date, timedelta, time
+from hashlib import md5
 
-from django.db.models import Q
-from django.http import Http404, HttpResponse, JsonResponse
+from django.db.models import Count, Max, Q
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.views.generic import ListView, DetailView
 from django.views.generic.base import TemplateView
 from django.core import serializers
-from icalendar import Calendar
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from dal import autocomplete
 
-from mezzanine_agenda import __version__
-from mezzanine_agenda.models import Event, EventLocation,\
-    ExternalShop, Season, EventPrice
+from mezzanine_agenda.models import Event, EventCategory, EventLocation,\
+    ExternalShop, Season, EventPrice, prime_absolute_urls
 from mezzanine_agenda.feeds import EventsRSS, EventsAtom
+from mezzanine_agenda.ical import make_calendar, stream_calendar
+from mezzanine_agenda.recurrence import expand_occurrences, recurring_between
 from mezzanine.conf import settings
 from mezzanine.generic.models import Keyword
 from mezzanine.utils.views import render
 from mezzanine.utils.models import get_user_model
-from django.utils.translation import ugettext_lazy as _
 from django.utils.text import slugify
-from django.utils import translation
+from django.utils import timezone, translation
 
-from mezzanine_agenda.forms import EventFilterForm
+from mezzanine_agenda.cache import cache_key, get_excluded_keywords, get_or_set,\
+    get_version, next_transition
+from mezzanine_agenda.forms import EventFilterForm, get_event_facets
+from mezzanine_agenda.utils import MONTH_CHOICES, count_events_by_day, day_bounds,\
+    group_events_by_month, iso_week_bounds, iso_week_monday  # noqa: F401
 
 User = get_user_model()
 
-MONTH_CHOICES = {
-    1: _('January'),
-    2: _('February'),
-    3: _('March'),
-    4: _('April'),
-    5: _('May'),
-    6: _('June'),
-    7: _('July'),
-    8: _('August'),
-    9: _('September'),
-    10: _('October'),
-    11: _('November'),
-    12: _('December'),
-}
-
-
-def next_weekday(d, weekday):
-    days_ahead = weekday - d.weekday()
-    if days_ahead <= 0:  # Target day already happened this week
-        days_ahead += 7
-    return d + timedelta(days_ahead)
-
 
 def week_day_range(year, week):
-    first_day = date(int(year), 1, 1)
-    lower_date = next_weekday(first_day, 0) + timedelta(weeks=int(week)-1)
+    lower_date = iso_week_monday(year, week)
     higher_date = lower_date + timedelta(days=int(6))
     return lower_date, higher_date
 
 
+def visible_events(request):
+    """
+    Return the events ``request.user`` can see: all of them for staff
+    users, the published ones otherwise.
+    """
+    if request.user.is_staff:
+        return Event.objects.all()
+    return Event.objects.published(for_user=request.user)
+
+
+def event_etag(request, events):
+    """
+    Return the ETag of a page showing ``events``, computed with a
+    single aggregate query cached until agenda data changes. The ETag
+    changes when an event of the set is saved, added or removed, and
+    when an event starts, ends, gets published or expires, since pages
+    show whether events are archived and their neighbours in time. It
+    is specific to the requested URL, language and user.
+    """
+    page = getattr(request, "page", None)
+    request_parts = (
+        request.get_full_path(),
+        request.is_ajax(),
+        request.user.pk,
+        getattr(page, "updated", None),
+    )
+    state = get_or_set(
+        cache_key("validators", *request_parts),
+        lambda: events.order_by().aggregate(
+            last_modified=Max("updated"),
+            count=Count("id", distinct=True),
+        )
+    )
+    fingerprint = "|".join(str(part) for part in request_parts + (
+        get_version(),
+        next_transition(),
+        translation.get_language(),
+        state["count"],
+        state["last_modified"],
+    ))
+    return quote_etag(md5(fingerprint.encode("utf-8")).hexdigest())
+
+
+def conditional_response(request, events, render_response):
+    """
+    Answer 304 Not Modified when the client's copy of the page showing
+    ``events`` is still valid, otherwise call ``render_response`` and
+    add the ETag header to its response.
+
+    No Last-Modified header is sent: the set of events can change
+    without any of them being modified, when one is deleted, expires
+    or ends, so the latest modification date can't tell whether the
+    client's copy is still valid.
+    """
+    etag = event_etag(request, events)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render_response()
+    if request.method in ("GET", "HEAD"):
+        response.setdefault("ETag", etag)
+    return response
+
+
 class EventListView(ListView):
     """
     Display a list of events that are filtered by tag, year, month, week,
@@ -72,6 +118,14 @@ class EventListView(ListView):
     form_initial = {}
 
     def get(self, request, *args, **kwargs):
+        self.events = self.get_events()
+        return conditional_response(
+            request,
+            self.events,
+            lambda: self.get_response(request, *args, **kwargs)
+        )
+
+    def get_response(self, request, *args, **kwargs):
         response = super(EventListView, self).get(request, *args, **kwargs)
         # AJAX
         if request.is_ajax():
@@ -79,7 +133,12 @@ class EventListView(ListView):
             response = JsonResponse(object_list_json, safe=False)
         return response
 
-    def get_queryset(self, tag=None):
+    def get_events(self):
+        """
+        Return the events matching the URL and the filter form, and
+        store the filters on the view for the template context.
+        """
+        self.form_initial = {}
         self.templates = []
         self.day_date = None
         events = None
@@ -96,33 +155,47 @@ class EventListView(ListView):
         self.week = None if "week" not in self.kwargs else self.kwargs['week']
 
         # display all events if user belongs to the staff
-        if self.request.user.is_staff:
-            events = Event.objects.all()
-        else:
-            events = Event.objects.published(for_user=self.request.user)
+        events = visible_events(self.request)
 
         # if not day:
         #     events = events.filter(parent=None)
-        if self.year is not None:
-            events = events.filter(start__year=self.year)
+        # occurrences of recurring events are listed for this window
+        self.window = (timezone.now(), None)
+        if self.year is not None and self.week is not None:
+            try:
+                self.window = iso_week_bounds(self.year, self.week)
+            except ValueError:
+                raise Http404()
+            dates = Q(start__gte=self.window[0], start__lt=self.window[1])
+            events = events.filter(dates | recurring_between(*self.window))
+        elif self.year is not None:
+            dates = Q(start__year=self.year)
+            first_day = date(int(self.year), 1, 1)
+            last_day = date(int(self.year), 12, 31)
             if self.month is not None:
-                events = events.filter(start__month=self.month)
+                dates &= Q(start__month=self.month)
                 try:
                     month_orig = self.month
                     self.month = month_name[int(self.month)]
                 except IndexError:
                     raise Http404()
+                first_day = date(int(self.year), int(month_orig), 1)
+                last_day = first_day.replace(
+                    day=monthrange(first_day.year, first_day.month)[1]
+                )
                 if self.day is not None:
-                    events = events.filter(start__day=self.day)
-                    self.day_date = date(
-                        year=int(self.year),
-                        month=int(month_orig),
-                        day=int(self.day)
-                    )
-            elif self.week is not None:
-                events = events.filter(start__year=self.year)
-                lower_date, higher_date = week_day_range(self.year, self.week)
-                events = events.filter(start__range=(lower_date, higher_date))
+                    dates &= Q(start__day=self.day)
+                    try:
+                        self.day_date = date(
+                            year=int(self.year),
+                            month=int(month_orig),
+                            day=int(self.day)
+                        )
+                    except ValueError:
+                        raise Http404()
+                    first_day = last_day = self.day_date
+            self.window = day_bounds(first_day, last_day)
+            events = events.filter(dates | recurring_between(*self.window))
         if self.location is not None:
             self.location = get_object_or_404(EventLocation, slug=self.location)
             events = events.filter(location=self.location)
@@ -136,104 +209,94 @@ class EventListView(ListView):
             events = events.filter(user=self.author)
             self.templates.append(u"agenda/event_list_%s.html" % self.username)
 
-        if not self.year and not self.location and not self.username:
+        self.upcoming = not self.year and not self.location and not self.username
+        if self.upcoming:
             # Get upcoming events/ongoing events
-            events = events.filter(
-                Q(start__gt=datetime.now()) | Q(end__gt=datetime.now())
-            )
+            events = events.upcoming()
 
-        # Filter by locations
-        event_locations_filter = self.request.GET.getlist('event_locations_filter')
+        # Filter by locations and categories
+        facet_filters = {}
+        event_locations_filter = self.get_filter_ids(
+            'event_locations_filter', EventLocation, 'title'
+        )
         if event_locations_filter:
-            events = events.filter(location__title__in=event_locations_filter)
+            facet_filters['location_id__in'] = event_locations_filter
             self.form_initial['event_locations_filter'] = event_locations_filter
-
-        # Filter by categories
-        event_categories_filter = self.request.GET.getlist('event_categories_filter')
+        event_categories_filter = self.get_filter_ids(
+            'event_categories_filter', EventCategory, 'name'
+        )
         if event_categories_filter:
-            events = events.filter(category__name__in=event_categories_filter)
+            facet_filters['category_id__in'] = event_categories_filter
             self.form_initial['event_categories_filter'] = event_categories_filter
 
         prefetch = ("keywords__keyword",)
         events = events.select_related("user").prefetch_related(*prefetch)
         self.templates.append(self.template_name)
 
-        self.tag_list = events.values_list(
-            'keywords__keyword',
-            flat=True,
-        )
-        self.tag_list = list(dict.fromkeys(self.tag_list))
-        removed = []
-        for tag in self.tag_list:
-            if tag is None or tag in settings.EVENT_EXCLUDE_TAG_LIST:
-                removed.append(tag)
-        for tag in removed:
-            self.tag_list.remove(tag)
-        self.tag_list = Keyword.objects.filter(id__in=self.tag_list)
+        # keywords of the events, before filtering them by tag
+        self.tag_list = Keyword.objects.filter(
+            id__in=events.filter(**facet_filters).order_by().values(
+                'keywords__keyword'
+            )
+        ).exclude(id__in=settings.EVENT_EXCLUDE_TAG_LIST)
 
         if self.tag is not None:
             self.tag = get_object_or_404(Keyword, slug=self.tag)
             events = events.filter(keywords__keyword=self.tag)
         else:
-            for exclude_tag_id in settings.EVENT_EXCLUDE_TAG_LIST:
-                exclude_tag = get_object_or_404(Keyword, id=exclude_tag_id)
-                events = events.exclude(keywords__keyword=exclude_tag)
-
-        months = events.order_by(
-            "start"
-        ).values_list(
-            'start__month',
-            'start__year'
-        )
-        months = list(dict.fromkeys(months))
-
-        if months:
-            already = []
-            events_by_month = {}
-            for month, year in months:
-                with translation.override('fr'):
-                    m = str(MONTH_CHOICES[month])
-                events_by_month[
-                    m +
-                    ' ' +
-                    str(year) +
-                    ',' +
-                    MONTH_CHOICES[month] +
-                    ' ' +
-                    str(year)
-                ] = []
-                digit_month = int(month)
-                first_day_in_month = date(year, digit_month, 1)
-                last_day_in_month = date(
-                    year, digit_month,
-                    monthrange(year, digit_month)[1]
+            excluded_keywords = get_excluded_keywords()
+            if excluded_keywords:
+                events = events.exclude(
+                    keywords__keyword_id__in=list(excluded_keywords)
                 )
-                tmp = events\
-                    .filter(
-                        start__year=year,
-                    )\
-                    .filter(
-                        (
-                            Q(start__lt=first_day_in_month,)
-                            & Q(end__gt=last_day_in_month)
-                        )
-                        | Q(start__range=(first_day_in_month, last_day_in_month))
-                        | Q(start__month=month)
-                    ).order_by("start")
-                for event in tmp:
-                    if event.id not in already:
-                        with translation.override('fr'):
-                            m = str(MONTH_CHOICES[month])
-                        events_by_month[
-                            m +
-                            ' ' +
-                            str(year) +
-                            ',' +
-                            MONTH_CHOICES[month] +
-                            ' ' +
-                            str(year)
-                        ].append(event)
-                        already.append(event.id)
+
+        # facets are counted before the category and location filters,
+        # each one applying the filter of the other, so that selecting an
+        # option doesn't hide the other ones
+        self.facet_events = events
+        return events.filter(**facet_filters)
+
+    def cache_key(self, name):
+        """
+        Agenda cache key of ``name`` for the requested page.
+        """
+        return cache_key(
+            name,
+            self.__class__.__name__,
+            self.request.get_full_path(),
+            self.request.user.is_staff
+        )
+
+    def get_filter_ids(self, name, model, title_field):
+        """
+        Return the ids selected in the ``name`` field of the filter form.
+        Values of ``title_field``, which the form used to submit, are
+        looked up among the ``model`` objects so that old URLs still
+        filter events.
+        """
+        values = self.request.GET.getlist(name)
+        ids = [str(int(value)) for value in values if value.isdigit()]
+        titles = [value for value in values if value and not value.isdigit()]
+        if titles:
+            ids += [str(pk) for pk in model.objects.filter(
+                **{"%s__in" % title_field: titles}
+            ).values_list("pk", flat=True)]
+        return ids
+
+    def get_queryset(self, tag=None):
+        events = self.events.with_booking_state()
+
+        def group_events():
+            # lists without dates also keep the recurring events which
+            # ended, along with the upcoming occurrences of the others
+            ordered_events = expand_occurrences(
+                events.order_by("start"), *self.window,
+                keep_past=not self.year and not self.upcoming
+            )
+            return group_events_by_month(prime_absolute_urls(ordered_events))
+
+        events_by_month = get_or_set(self.cache_key("events"), group_events)
+        if events_by_month:
             return events_by_month  # events in template context
 
         return events
@@ -279,7 +342,10 @@ class EventListView(ListView):
                 "month": self.month,
                 "day": self.day,
                 "week": self.week,
-                "tag_list": self.tag_list,
+                "tag_list": get_or_set(
+                    self.cache_key("tags"),
+                    lambda: list(self.tag_list)
+                ),
                 "tag": self.tag,
                 "location": self.location,
                 "author": self.author,
@@ -291,7 +357,17 @@ class EventListView(ListView):
         )
 
         context['event_tag_highlighted'] = getattr(settings, 'EVENT_TAG_HIGHLIGHTED', 0)
-        context['filter_form'] = EventFilterForm(initial=self.form_initial)
+        context['filter_form'] = EventFilterForm(
+            initial=self.form_initial,
+            facets=get_or_set(
+                self.cache_key("facets"),
+                lambda: get_event_facets(
+                    self.facet_events,
+                    self.form_initial.get('event_categories_filter'),
+                    self.form_initial.get('event_locations_filter'),
+                )
+            )
+        )
         if settings.PAST_EVENTS:
             context['past_events'] = Event.objects.filter(
                 end__lt=datetime.now()
@@ -349,10 +425,16 @@ class ArchiveListView(ListView):
                 date_max = datetime.combine(season.end, time(23, 59, 59))
             else:
                 date_max = date_now
+            # occurrences of recurring events are listed for this window
+            lower, upper = day_bounds(season.start, season.end)
+            self.window = (lower, min(upper, timezone.now()))
             season.start = datetime.combine(season.start, time(0, 0, 0))
             events = events.filter(
-                Q(start__range=[season.start, date_max]) &
-                Q(end__range=[season.start, date_max])
+                (
+                    Q(start__range=[season.start, date_max]) &
+                    Q(end__range=[season.start, date_max])
+                )
+                | recurring_between(*self.window)
             ).order_by("-start")
 
             # filter by month
@@ -363,6 +445,9 @@ class ArchiveListView(ListView):
                     digit_year, digit_month,
                     monthrange(digit_year, digit_month)[1]
                 )
+                self.window = self._clip_window(
+                    day_bounds(first_day_in_month, last_day_in_month)
+                )
                 # works for periods containing the month or a period in the month
                 events = events.filter(
                     (
@@ -372,6 +457,7 @@ class ArchiveListView(ListView):
                     | Q(start__range=(first_day_in_month, last_day_in_month))
                     | Q(end__month=self.month)
                     | Q(start__month=self.month)
+                    | recurring_between(*self.window)
                 ).order_by("start")
                 try:
                     month_orig = self.month
@@ -379,70 +465,40 @@ class ArchiveListView(ListView):
                 except IndexError:
                     raise Http404()
                 if self.day is not None:
-                    events = events.filter(start__day=self.day)
-                    self.day_date = date(
-                        year=digit_year,
-                        month=int(month_orig),
-                        day=int(self.day)
+                    try:
+                        self.day_date = date(
+                            year=digit_year,
+                            month=int(month_orig),
+                            day=int(self.day)
+                        )
+                    except ValueError:
+                        raise Http404()
+                    self.window = self._clip_window(
+                        day_bounds(self.day_date, self.day_date)
+                    )
+                    events = events.filter(
+                        Q(start__day=self.day) | recurring_between(*self.window)
                     )
-        months = events.order_by(
-            "-start"
-        ).values_list(
-            'start__month',
-            'start__year'
+        events_by_month = get_or_set(
+            cache_key(
+                "archive",
+                self.request.get_full_path(),
+                self.request.user.is_staff
+            ),
+            lambda: group_events_by_month(prime_absolute_urls(
+                expand_occurrences(events, *self.window)[::-1]
+            ), reverse=True)
         )
-        months = list(dict.fromkeys(months))
-        if months:
-            already = []
-            events_by_month = {}
-            for month, year in months:
-
-                with translation.override('fr'):
-                    m = str(MONTH_CHOICES[month])
-                events_by_month[
-                    m +
-                    ' ' +
-                    str(year) +
-                    ',' +
-                    MONTH_CHOICES[month] +
-                    ' ' +
-                    str(year)
-                ] = []
-                digit_month = int(month)
-                first_day_in_month = date(digit_year, digit_month, 1)
-                last_day_in_month = date(
-                    digit_year, digit_month,
-                    monthrange(digit_year, digit_month)[1]
-                )
-                tmp = events\
-                    .filter(
-                        start__year=year,
-                    )\
-                    .filter(
-                        (
-                            Q(start__lt=first_day_in_month,)
-                            & Q(end__gt=last_day_in_month)
-                        )
-                        | Q(start__range=(first_day_in_month, last_day_in_month))
-                        | Q(start__month=month)
-                    ).order_by("-start")
-                for event in tmp:
-                    if event.id not in already:
-                        with translation.override('fr'):
-                            m = str(MONTH_CHOICES[month])
-                        events_by_month[
-                            m +
-                            ' ' +
-                            str(year) +
-                            ',' +
-                            MONTH_CHOICES[month] +
-                            ' ' +
-                            str(year)
-                        ].append(event)
-                        already.append(event.id)
+        if events_by_month:
             return events_by_month  # events in template context
         return events
 
+    def _clip_window(self, window):
+        """
+        Restrict ``window`` to the dates of the season being archived.
+        """
+        return max(window[0], self.window[0]), min(window[1], self.window[1])
+
     def get_context_data(self, *args, **kwargs):
         tmp = self.request.page
         root = self.request.page
@@ -497,10 +553,14 @@ def event_detail(
     events's slug.
     """
     events = Event.objects.published(for_user=request.user).select_related()
-    event = get_object_or_404(events, slug=slug)
-    context = {"event": event, }
-    templates = [u"agenda/event_detail_%s.html" % str(slug), template]
-    return render(request, templates, context)
+
+    def render_event():
+        event = get_object_or_404(events.with_booking_state(), slug=slug)
+        context = {"event": event, }
+        templates = [u"agenda/event_detail_%s.html" % str(slug), template]
+        return render(request, templates, context)
+
+    return conditional_response(request, events.filter(slug=slug), render_event)
 
 
 def event_booking(
@@ -517,7 +577,7 @@ def event_booking(
     """
     events = Event.objects.published(
                                      for_user=request.user).select_related()
-    event = get_object_or_404(events, slug=slug)
+    event = get_object_or_404(events.with_booking_state(), slug=slug)
     if event.is_full:
         return redirect('event_detail', slug=event.slug)
     shop_url = ''
@@ -541,22 +601,43 @@ def event_feed(request, format, **kwargs):
     Events feeds - maps format to the correct feed view.
     """
     try:
-        return {"rss": EventsRSS, "atom": EventsAtom}[format](**kwargs)(request)
+        feed = {"rss": EventsRSS, "atom": EventsAtom}[format](**kwargs)
     except KeyError:
         raise Http404()
+    return conditional_response(request, feed.get_events(), lambda: feed(request))
 
 
-def _make_icalendar():
+def event_day_counts(request, year=None, month=None):
     """
-    Create an icalendar object.
+    Returns the number of events of each day of a month, or of the
+    range given by the ``start`` and ``end`` (YYYY-MM-DD) parameters,
+    as JSON.
     """
-    icalendar = Calendar()
-    icalendar.add(
-        'prodid',
-        '-//mezzanine-agenda//NONSGML V{}//EN'.format(__version__)
+    try:
+        if year is not None:
+            first_day = date(int(year), int(month), 1)
+            last_day = first_day.replace(day=monthrange(first_day.year,
+                                                        first_day.month)[1])
+        else:
+            first_day, last_day = [
+                datetime.strptime(request.GET[name], "%Y-%m-%d").date()
+                for name in ("start", "end")
+            ]
+    except (KeyError, ValueError):
+        raise Http404()
+    if not timedelta(0) <= last_day - first_day <= timedelta(
+            days=settings.EVENT_DAY_COUNTS_MAX_DAYS - 1):
+        raise Http404()
+    events = visible_events(request)
+    days = get_or_set(
+        cache_key("day_counts", first_day, last_day, request.user.is_staff),
+        lambda: count_events_by_day(events, first_day, last_day)
     )
-    icalendar.add('version', '2.0')  # version of the format, not the product!
-    return icalendar
+    return JsonResponse({
+        "start": first_day.isoformat(),
+        "end": last_day.isoformat(),
+        "days": {day.isoformat(): count for day, count in days.items()},
+    })
 
 
 def icalendar_event(request, slug, year=None, month=None, day=None):
@@ -565,13 +646,19 @@ def icalendar_event(request, slug, year=None, month=None, day=None):
     """
     events = Event.objects.published(
                                      for_user=request.user).select_related()
-    event = get_object_or_404(events, slug=slug)
 
-    icalendar = _make_icalendar()
-    icalendar_event = event.get_icalendar_event()
-    icalendar.add_component(icalendar_event)
+    def render_icalendar():
+        event = get_object_or_404(events, slug=slug)
+        icalendar = make_calendar()
+        icalendar_event = event.get_icalendar_event()
+        icalendar.add_component(icalendar_event)
+        return HttpResponse(icalendar.to_ical(), content_type="text/calendar")
 
-    return HttpResponse(icalendar.to_ical(), content_type="text/calendar")
+    return conditional_response(
+        request,
+        events.filter(slug=slug),
+        render_icalendar
+    )
 
 
 def icalendar(
@@ -607,20 +694,12 @@ def icalendar(
         events = events.filter(user=author)
     if not tag and not year and not location and not username:
         # Get upcoming events/ongoing events
-        events = events.filter(
-            Q(start__gt=datetime.now()) |
-            Q(end__gt=datetime.now())
-        ).order_by("start")
-
-    prefetch = ("keywords__keyword",)
-    events = events.select_related("user").prefetch_related(*prefetch)
-
-    icalendar = _make_icalendar()
-    for event in events:
-        icalendar_event = event.get_icalendar_event()
-        icalendar.add_component(icalendar_event)
+        events = events.upcoming().order_by("start")
 
-    return HttpResponse(icalendar.to_ical(), content_type="text/calendar")
+    return conditional_response(request, events, lambda: StreamingHttpResponse(
+        stream_calendar(events),
+        content_type="text/calendar"
+    ))
 
 
 class LocationListView(ListView):
@@ -36,6 +36,7 @@ setup(
         "icalendar==4.0.3",
         "geopy==1.17.0",
         "pytz>=2018.7",
+        "python-dateutil>=2.7",
         "django-autocomplete-light==3.8.2"
     ]
 